@@ -1,4 +1,21 @@
+import sys
+
 from .__about__ import __version__
-from .server_extension import ImplectusContentsManager, load_jupyter_server_extension
 
 __all__ = ["__version__", "ImplectusContentsManager", "load_jupyter_server_extension"]
+
+if sys.version_info >= (3, 7):
+    # Don't import the notebook server until it's needed (it's slow to import)
+    def __getattr__(name):
+        if name in ("ImplectusContentsManager", "load_jupyter_server_extension"):
+            from . import server_extension
+
+            return getattr(server_extension, name)
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+else:  # pragma: no cover
+    from .server_extension import (
+        ImplectusContentsManager,
+        load_jupyter_server_extension,
+    )
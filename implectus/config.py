@@ -1,11 +1,16 @@
+import copy
+import functools
 import os
-import unittest.mock as mock
+import stat
 import warnings
+from collections import OrderedDict
 from pathlib import Path
-from typing import Iterator, Optional, Union
+from typing import Iterator, Optional, Tuple, Union
 
 import jupytext.config
-from traitlets import Bool, Unicode
+from traitlets import Bool, TraitError, Unicode, observe
+
+from .util import FileState, file_state, is_settled
 
 try:
     # Introduced after 1.6.0
@@ -32,6 +37,46 @@ class ImplectusConfigError(JupytextConfigurationError):
     pass
 
 
+# Number of path calculations to cache for each configuration
+_PATH_CACHE_SIZE = 1024
+
+
+def _memoize_path_method(method):
+    """Memoize a path calculation on the configured paths and the given source path.
+
+    The configuration can change at any time (e.g. the contents manager's traits are
+    set from the command line), so the cache key includes every trait the path
+    calculations depend on.  Only the most recently used results are kept, since a
+    long-running contents manager can look up any number of paths.
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, source_file_path):
+        key = (
+            method.__name__,
+            self.working_dir,
+            self.source_dir,
+            self.code_dir,
+            self.doc_dir,
+            self.export_code_as_package,
+            str(source_file_path),
+        )
+        cache = self.__dict__.get("_path_cache")
+        if cache is None:
+            cache = self._path_cache = OrderedDict()
+        try:
+            result = cache[key]
+        except KeyError:
+            result = cache[key] = method(self, source_file_path)
+            while len(cache) > _PATH_CACHE_SIZE:
+                cache.popitem(last=False)
+        else:
+            cache.move_to_end(key)
+        return result
+
+    return wrapper
+
+
 class ImplectusConfiguration(jupytext.config.JupytextConfiguration):
 
     """Implectus configuration.
@@ -125,7 +170,7 @@ class ImplectusConfiguration(jupytext.config.JupytextConfiguration):
 
     def _check_absoluteness(self, path):
         """Check that `path` and `root_path` are both absolute or both relative."""
-        if self.working_path.is_absolute() and not Path(path).is_absolute():
+        if os.path.isabs(self.working_dir) and not os.path.isabs(path):
             warnings.warn(
                 "Candidate paths must be absolute when the root dir is absolute",
                 ImplectusConfigWarning,
@@ -133,6 +178,50 @@ class ImplectusConfiguration(jupytext.config.JupytextConfiguration):
             return False
         return True
 
+    @observe("source_dir", "working_dir")
+    def _reset_source_prefix(self, change):
+        self._source_prefix = None
+
+    def _get_source_prefix(self):
+        """Return the normalized source path with a trailing separator (cached).
+
+        Returns "" if the source path is the current directory.
+        """
+        prefix = getattr(self, "_source_prefix", None)
+        if prefix is None:
+            prefix = os.path.normpath(self.source_path)
+            if prefix == os.curdir:
+                prefix = ""
+            elif not prefix.endswith(os.sep):
+                prefix += os.sep
+            self._source_prefix = prefix
+        return prefix
+
+    @observe("code_dir")
+    def _reset_package_name(self, change):
+        self._package_name = None
+
+    def _get_package_name(self):
+        """Return the name of the code directory, used as the package name (cached)."""
+        package_name = getattr(self, "_package_name", None)
+        if package_name is None:
+            parts = Path(self.code_dir).parts
+            package_name = parts[-1] if parts else ""
+            self._package_name = package_name
+        return package_name
+
+    def _in_source_dir(self, normalized_path):
+        """Check if a normalized path is inside the source directory."""
+        prefix = self._get_source_prefix()
+        if not prefix:
+            # Anything relative that isn't above the current directory
+            return not (
+                os.path.isabs(normalized_path)
+                or normalized_path in (os.curdir, os.pardir)
+                or normalized_path.startswith(os.pardir + os.sep)
+            )
+        return normalized_path.startswith(prefix)
+
     def should_process(self, path):
         """Check if a path should be treated as a source document."""
         if not self.source_dir:
@@ -140,7 +229,25 @@ class ImplectusConfiguration(jupytext.config.JupytextConfiguration):
         if not self._check_absoluteness(path):
             return False
         # source_path and path are either both relative or both absolute
-        return self.source_path in Path(path).parents
+        return self._in_source_dir(os.path.normpath(path))
+
+    def _relative_str_to_source(self, source_file_path):
+        """Get the path to the given source file relative to the source folder.
+
+        Does the same as `_relative_path_to_source`, but returns a string.
+        """
+        if not self.source_dir:
+            return None
+        # TODO: when does this matter?
+        if not self._check_absoluteness(source_file_path):
+            return None
+        path = os.path.normpath(source_file_path)
+        if not self._in_source_dir(path):
+            raise ValueError(
+                "%r is not in the source directory %r"
+                % (str(source_file_path), str(self.source_path))
+            )
+        return path[len(self._get_source_prefix()) :]
 
     def _relative_path_to_source(self, source_file_path):
         """Get the path to the given source file relative to the source folder.
@@ -150,35 +257,35 @@ class ImplectusConfiguration(jupytext.config.JupytextConfiguration):
                 to the root dir.
             ValueError: if the source file is not in the source folder.
         """
-        if not self.source_dir:
+        relative_path = self._relative_str_to_source(source_file_path)
+        if relative_path is None:
             return None
-        # TODO: when does this matter?
-        if not self._check_absoluteness(source_file_path):
-            return None
-        src = Path(source_file_path)
-        return src.relative_to(self.source_path)
+        return Path(relative_path)
 
+    @_memoize_path_method
     def code_path_for_source(self, source_file_path):
         """Get the path of the module into which to export the given source's code."""
         filename = self._relative_path_to_source(source_file_path)
         if filename and self.code_dir:
             return self.code_path / filename.with_suffix(".py")
 
+    @_memoize_path_method
     def module_name(self, source_file_path):
         """Calculate the module name for the given source notebook when exported."""
         self.validate_config()
         if not self.source_dir:
             return
         if self.export_code_as_package:
-            package = Path(self.code_dir).parts[-1]
-            relative_path = self._relative_path_to_source(source_file_path)
+            package = self._get_package_name()
+            relative_path = self._relative_str_to_source(source_file_path)
             if relative_path is not None:
-                module_path = Path(package) / relative_path.with_suffix("")
-                return ".".join(module_path.parts)
+                module_path = os.path.splitext(relative_path)[0]
+                return ".".join([package] + module_path.split(os.sep))
         else:
             # TODO: Is this even useful?
-            return Path(source_file_path).with_suffix("").name
+            return os.path.splitext(os.path.basename(source_file_path))[0]
 
+    @_memoize_path_method
     def doc_path_for_source(self, source_file_path):
         """Get the path of the module into which to export the given source's docs."""
         if not self.source_dir or not self.doc_dir:
@@ -223,6 +330,27 @@ def find_global_config() -> Optional[str]:
     return None
 
 
+def _dir_state(path) -> Optional[FileState]:
+    """Return the state of a directory, or None if it isn't one."""
+    try:
+        st = os.stat(path)
+    except (OSError, ValueError):
+        return None
+    return file_state(st) if stat.S_ISDIR(st.st_mode) else None
+
+
+def _config_search_dirs(path, search_parent_dirs=True) -> Iterator[str]:
+    """Return the directories _find_config might look in when starting at `path`."""
+    while True:
+        yield path
+        parent = os.path.dirname(path)
+        if not search_parent_dirs or parent == path:
+            break
+        path = parent
+    if search_parent_dirs:
+        yield from _global_config_dirs()
+
+
 def _find_config(path, search_parent_dirs=True) -> Optional[str]:
     """Search for Implectus or Jupytext config files, starting at the given path.
 
@@ -230,21 +358,88 @@ def _find_config(path, search_parent_dirs=True) -> Optional[str]:
     any of the directories in the `IMPLECTUS_CEILING_DIRS` and `JUPYTEXT_CEILING_DIRS`
     environment variables are reached.  Finally, search the global config directories.
 
+    The result is cached until one of the directories searched is modified (which is
+    what happens when a config file is created, deleted or renamed), or the list of
+    global config directories changes.  It isn't cached while any of the directories
+    have been modified too recently for their timestamps to show further changes.
+
     Returns: the path to the first config file found.
     """
-    with mock.patch.multiple(
-        "jupytext.config",
-        JUPYTEXT_CONFIG_FILES=IMPLECTUS_CONFIG_FILES,
-        find_global_jupytext_configuration_file=find_global_config,
-    ):
-        return jupytext.config.find_jupytext_configuration_file(
-            path, search_parent_dirs
-        )
+    path = str(path)
+    search_dirs = tuple(_config_search_dirs(path, search_parent_dirs))
+    dir_states = tuple(_dir_state(d) for d in search_dirs)
+    if not all(is_settled(state) for state in dir_states):
+        return _find_config_impl(path, search_parent_dirs)
+    return _find_config_cached(
+        os.getcwd(), path, search_parent_dirs, search_dirs, dir_states
+    )
+
+
+@functools.lru_cache(maxsize=256)
+def _find_config_cached(
+    cwd: str,
+    path: str,
+    search_parent_dirs: bool,
+    search_dirs: Tuple[str, ...],
+    dir_states: Tuple[Optional[FileState], ...],
+) -> Optional[str]:
+    """Implementation of _find_config, memoized on the state of the filesystem."""
+    return _find_config_impl(path, search_parent_dirs)
+
+
+def _find_config_impl(path: str, search_parent_dirs=True) -> Optional[str]:
+    """Implementation of _find_config.
+
+    This is `jupytext.config.find_jupytext_configuration_file`, but looking for
+    Implectus config files too.
+    """
+    while True:
+        if os.path.isdir(path):
+            for filename in IMPLECTUS_CONFIG_FILES:
+                full_path = os.path.join(path, filename)
+                if os.path.isfile(full_path):
+                    return full_path
+
+        if not search_parent_dirs:
+            return None
+
+        if IMPLECTUS_CEILING_DIRECTORIES and os.path.isdir(path):
+            for ceiling_dir in IMPLECTUS_CEILING_DIRECTORIES:
+                if os.path.isdir(ceiling_dir) and os.path.samefile(path, ceiling_dir):
+                    return None
+
+        parent_dir = os.path.dirname(path)
+        if parent_dir == path:
+            return find_global_config()
+        path = parent_dir
 
 
 def load_config_file(config_file_path: str, *args, **kwargs):
     """Read an Implectus or Jupytext config file (TOML, YAML, Python, or JSON)."""
     # TODO: doc
+    if not args and not kwargs:
+        # Reading from disk, so the result can be cached until the file changes (unless
+        # it has changed too recently to tell)
+        try:
+            state = file_state(os.stat(config_file_path))
+        except OSError:
+            pass
+        else:
+            if is_settled(state):
+                config = _load_config_file_cached(
+                    os.path.abspath(config_file_path), state
+                )
+                return copy.deepcopy(config)
+    return _load_config_file(config_file_path, *args, **kwargs)
+
+
+@functools.lru_cache(maxsize=64)
+def _load_config_file_cached(config_file_path: str, state: FileState):
+    """Implementation of load_config_file, memoized on the file's state."""
+    return _load_config_file(config_file_path)
+
+
+def _load_config_file(config_file_path: str, *args, **kwargs):
     try:
         return jupytext.config.load_jupytext_configuration_file(
             config_file_path, *args, **kwargs
@@ -258,12 +453,24 @@ def construct_config(
 ) -> Optional[ImplectusConfiguration]:
     """Turn a dict-like config into an ImplectusConfiguration."""
     # TODO: doc
-    with mock.patch.multiple(
-        "jupytext.config", JupytextConfiguration=ImplectusConfiguration
-    ):
-        return jupytext.config.validate_jupytext_configuration_file(
-            config_file_path, config
+    # Same as jupytext.config.validate_jupytext_configuration_file
+    if config is None:
+        return None
+    try:
+        implectus_config = ImplectusConfiguration(**config)
+    except TraitError as e:
+        raise ImplectusConfigError(
+            "The Implectus configuration file {} is incorrect: {}".format(
+                config_file_path, e
+            )
         )
+    invalid_options = set(config).difference(dir(ImplectusConfiguration()))
+    if invalid_options:
+        raise ImplectusConfigError(
+            "The Implectus configuration file {} is incorrect: options {} are not "
+            "supported".format(config_file_path, ",".join(invalid_options))
+        )
+    return implectus_config
 
 
 def validate_config(
@@ -292,6 +499,20 @@ def validate_config(
     return config
 
 
+def _is_same_file(path, other_path) -> bool:
+    """Check if `path` is a regular file and is the same file as `other_path`."""
+    try:
+        st = os.stat(path)
+        other_st = os.stat(other_path)
+    except (OSError, ValueError):
+        return False
+    return (
+        stat.S_ISREG(st.st_mode)
+        and st.st_ino == other_st.st_ino
+        and st.st_dev == other_st.st_dev
+    )
+
+
 def load_config_for_path(notebook_path):
     """Load the Implectus or Jupytext config file that applies to the given notebook."""
     # TODO: doc
@@ -300,9 +521,7 @@ def load_config_for_path(notebook_path):
         return None
 
     # TODO: put this in find_config?
-    # TODO: this needs its own test
-    notebook_path = Path(notebook_path)
-    if notebook_path.is_file() and notebook_path.samefile(config_file):
+    if _is_same_file(notebook_path, config_file):
         # Inherited from Jupytext; I guess this filters out implectus.py
         return None
 
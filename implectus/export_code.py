@@ -1,6 +1,6 @@
 """Helper functions for exporting code."""
 import copy
-import itertools
+import functools
 import re
 from pathlib import Path
 from typing import Union, cast
@@ -14,12 +14,14 @@ from .util import (
     implectus_header_cell,
     is_private,
     jupytext_writes,
+    write_file,
 )
 
+_export_tags = frozenset({"export", "export-internal"})
+
 
 def should_export(cell):
-    tags = cell.metadata.get("tags", {})
-    return "export" in tags or "export-internal" in tags
+    return not _export_tags.isdisjoint(cell.metadata.get("tags") or ())
 
 
 def relative_import(name, current_module):
@@ -28,14 +30,25 @@ def relative_import(name, current_module):
     current_module = current_module.split(".")
     assert len(current_module) > 1
     parent_module = current_module[:-1]
-    common_part = list(
-        itertools.takewhile(lambda x: x[0] == x[1], zip(name, parent_module))
-    )
-    if len(common_part) == 0:
+    # Length of common prefix
+    common = 0
+    max_common = min(len(name), len(parent_module))
+    while common < max_common and name[common] == parent_module[common]:
+        common += 1
+    if common == 0:
         # name is not in the same package as current_module
         return ".".join(name)
-    common_ancestor_name = "." * (len(current_module) - len(common_part))
-    return common_ancestor_name + ".".join(name[len(common_part) :])
+    common_ancestor_name = "." * (len(current_module) - common)
+    return common_ancestor_name + ".".join(name[common:])
+
+
+@functools.lru_cache(maxsize=None)
+def _import_re(package_name):
+    """Compile the regex matching ```from package[.sibling] import ...``` lines."""
+    return re.compile(
+        rf"^(\s*from )({re.escape(package_name)}\.?\S*)( import .*)$",
+        flags=re.MULTILINE,
+    )
 
 
 def relativize_imports(cell, module_name):
@@ -44,31 +57,46 @@ def relativize_imports(cell, module_name):
     Note that there's no way to make ```import package``` into a relative import,
     and doing it for ```import package.sibling``` is more work than I care to do, so
     only ```from package[.sibling]```-style imports are supported.
+
+    The cell is copied if any imports are changed, otherwise it's returned as-is.
     """
     if cell.cell_type != "code":
         return cell
     # TODO: warn on absolute imports
     package_name = module_name.split(".")[0]
-    re_import = re.compile(
-        rf"^(\s*from )({package_name}\.?\S*)( import .*)$", flags=re.MULTILINE
-    )
-    cell.source = re_import.sub(
+    if "from " not in cell.source or package_name not in cell.source:
+        # Most cells don't import anything from the package, so skip the regex
+        return cell
+    source, count = _import_re(package_name).subn(
         lambda m: "".join((m[1], relative_import(m[2], module_name), m[3])), cell.source
     )
+    if count:
+        cell = copy.copy(cell)
+        cell.source = source
     return cell
 
 
-_re_function_def = re.compile(r"^(?:async\s+)?def\s+([^\(\s]+)\s*\(", re.MULTILINE)
-_re_class_def = re.compile(r"^class\s+([^\(\s]+)\s*(?:\(|:)", re.MULTILINE)
+_re_definition = re.compile(
+    r"^(?:(?:async\s+)?def\s+(?P<function>[^\(\s]+)\s*\("
+    r"|class\s+(?P<class>[^\(\s]+)\s*(?:\(|:))",
+    re.MULTILINE,
+)
 
 
 def exported_names(cell):
+    """Return the public (name, type) pairs defined in an exported code cell.
+
+    The names are in the order they're defined, and the type is "function" or "class".
+    """
     if cell.cell_type != "code" or not should_export(cell):
         return []
-    functions = _re_function_def.findall(cell.source)
-    classes = _re_class_def.findall(cell.source)
-    names = [(f, "function") for f in functions] + [(c, "class") for c in classes]
-    return [(name, type_) for (name, type_) in names if not is_private(name)]
+    names = []
+    for match in _re_definition.finditer(cell.source):
+        type_ = "function" if match["function"] else "class"
+        name = match[type_]
+        if not is_private(name):
+            names.append((name, type_))
+    return names
 
 
 def writes_code(
@@ -85,19 +113,21 @@ def writes_code(
         source_filename: Full path of the file from which notebook was read.
         config: The Implectus configuration.
     """
-    nb = copy.deepcopy(notebook)
-
-    nb.cells = [cell for cell in nb.cells if should_export(cell)]
+    # Only the notebook metadata is modified (relativize_imports copies any cells it
+    # changes), so there's no need to copy the whole notebook
+    nb = copy.copy(notebook)
+    nb.cells = [cell for cell in notebook.cells if should_export(cell)]
     if config.export_code_as_package:
-        nb.cells = [
-            relativize_imports(cell, config.module_name(source_filename))
-            for cell in nb.cells
-        ]
+        module_name = config.module_name(source_filename)
+        nb.cells = [relativize_imports(cell, module_name) for cell in nb.cells]
 
     # Insert Implectus header
     nb.cells.insert(0, implectus_header_cell(source_filename))
 
-    nb.metadata.setdefault("jupytext", {})["notebook_metadata_filter"] = "-all"
+    nb.metadata = copy.copy(notebook.metadata)
+    nb.metadata["jupytext"] = dict(
+        nb.metadata.get("jupytext", {}), notebook_metadata_filter="-all"
+    )
     return jupytext_writes(nb, config.code_format)
 
 
@@ -123,8 +153,6 @@ def write_code(
     if not hasattr(fp, "write"):
         # fp is a filename
         assert_overwriteable(fp)
-        path = Path(fp)
-        path.parent.mkdir(parents=True, exist_ok=True)
-        return write_code(notebook, source_filename, config, path.open("w"))
+        return write_file(fp, writes_code(notebook, source_filename, config))
     fp = cast(TextIO, fp)
     fp.write(writes_code(notebook, source_filename, config))
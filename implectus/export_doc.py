@@ -11,24 +11,28 @@ from .config import ImplectusConfiguration
 from .export_code import exported_names
 from .util import (
     assert_overwriteable,
-    concat,
+    cell_tags,
     implectus_header_cell,
     jupytext_writes,
     nb_cell,
+    write_file,
 )
 
 __all__ = ["write_doc", "writes_doc"]
 
 
 def should_document(cell):
-    tags = cell.metadata.get("tags", {})
+    tags = cell_tags(cell)
     return "export-internal" not in tags and "remove-cell" not in tags
 
 
 _directives = "module|function|data|exception|class|decorator"
+# The directive body is matched up to the first closing fence without a lazy .*?, so
+# each character is only tried once (backticks are allowed as long as there aren't
+# three in a row)
 _re_sphinx_directive = re.compile(
-    r"^\s*```\s*{(?:py:|auto)?(?:%s)}\s+([^`\s(]*).*?```" % _directives,
-    re.MULTILINE | re.DOTALL,
+    r"^\s*```\s*{(?:py:|auto)?(?:%s)}\s+([^`\s(]*)(?:[^`]|`(?!``))*```" % _directives,
+    re.MULTILINE,
 )
 
 
@@ -36,34 +40,38 @@ def documented_names(cell):
     """For markdown cells, return the names that are already documented."""
     if cell.cell_type != "markdown" or not should_document(cell):
         return []
+    if "```" not in cell.source:
+        # Most markdown cells don't contain any code blocks, so skip the regex
+        return []
     return _re_sphinx_directive.findall(cell.source)
 
 
 def autodoc_directive_for_name(name, type_):
-    return "```{auto%s} %s```" % (type_, name)
+    return f"```{{auto{type_}}} {name}```"
 
 
 def document_cell(cell, skip_names):
     """Replace exported code cells with autodoc directives for the names they define.
 
     Args:
-        skip_names: List of names to skip.
+        skip_names: Set (ideally a frozenset) of names to skip.
 
     Returns:
         list of cells to insert where the cell was.
     """
-    tags = cell.metadata.get("tags", {})
     cells = [cell]
-    if "export" in tags:
+    if "export" in cell_tags(cell):
         # Create autodoc directives for any exported names that haven't been documented
-        # manually elsewhere in the notebook
+        # manually elsewhere in the notebook (keeping the order they're defined in)
         directives = [
             autodoc_directive_for_name(name, type_)
             for (name, type_) in exported_names(cell)
             if name not in skip_names
         ]
-        # Hide the cell's code
-        cell.metadata.tags.append("remove-input")
+        # Hide the cell's code (copying the cell so the source notebook is untouched)
+        cell = copy.copy(cell)
+        cell.metadata = copy.copy(cell.metadata)
+        cell.metadata["tags"] = list(cell.metadata["tags"]) + ["remove-input"]
         cells = [cell]
         if directives:
             # Insert a cell with the autodoc directives before this one in the notebook,
@@ -87,22 +95,25 @@ def writes_doc(
         source_filename: Full path of the file from which notebook was read.
         config: The Implectus configuration.
     """
-    nb = copy.deepcopy(notebook)
-
-    # Insert Implectus header
-    nb.cells.insert(0, implectus_header_cell(source_filename))
+    # Cells are only modified by document_cell, which copies them first
+    nb = copy.copy(notebook)
 
     # Insert py:currentmodule directive for autodoc
     module_name = config.module_name(source_filename)
     # TODO: should module_name() throw instead?
     assert module_name is not None
     directive = "```{py:currentmodule} %s```" % module_name
-    nb.cells.insert(1, nb_cell("markdown", directive))
 
-    # Filter cells and add autodoc directives
-    nb.cells = [cell for cell in nb.cells if should_document(cell)]
-    documented_names_ = concat(documented_names(cell) for cell in nb.cells)
-    nb.cells = concat(document_cell(cell, documented_names_) for cell in nb.cells)
+    # Filter cells (after the Implectus header and the directive, which are always
+    # documented) and add autodoc directives
+    cells = [implectus_header_cell(source_filename), nb_cell("markdown", directive)]
+    cells.extend(cell for cell in notebook.cells if should_document(cell))
+    documented_names_ = frozenset(
+        name for cell in cells for name in documented_names(cell)
+    )
+    nb.cells = []
+    for cell in cells:
+        nb.cells.extend(document_cell(cell, documented_names_))
 
     return jupytext_writes(nb, config.doc_format)
 
@@ -129,8 +140,6 @@ def write_doc(
     if not hasattr(fp, "write"):
         # fp is a filename
         assert_overwriteable(fp)
-        path = Path(fp)
-        path.parent.mkdir(parents=True, exist_ok=True)
-        return write_doc(notebook, source_filename, config, path.open("w"))
+        return write_file(fp, writes_doc(notebook, source_filename, config))
     fp = cast(TextIO, fp)
     fp.write(writes_doc(notebook, source_filename, config))
@@ -1,27 +1,315 @@
+import hashlib
+import itertools
+import json
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
 import jupytext
+from nbformat import NotebookNode
 
 from .config import ImplectusConfiguration
-from .export_code import write_code
-from .export_doc import write_doc
+from .export_code import write_code, writes_code
+from .export_doc import write_doc, writes_doc
+from .util import (
+    assert_overwriteable,
+    concat,
+    config_fingerprint,
+    config_values,
+    file_state,
+    is_settled,
+    write_files,
+)
+
+__all__ = [
+    "SYNC_MANIFEST_FILENAME",
+    "sync",
+    "write_code",
+    "write_doc",
+    "write_exports",
+]
 
 # TODO sanity checks:
 #   imports are translatable
 #   no conflicting tags
 
 
-def sync(config: ImplectusConfiguration):
-    """Export code and doc for each file in the source directory."""
+def _notebook_extensions(config: ImplectusConfiguration) -> Tuple[str, ...]:
+    """Parse config.notebook_extensions into a tuple of suffixes like ".ipynb"."""
+    extensions = (ext.strip() for ext in config.notebook_extensions.split(","))
+    return tuple(ext if ext.startswith(".") else "." + ext for ext in extensions if ext)
+
+
+def _iter_source_files(
+    source_path: Union[str, Path], extensions: Tuple[str, ...]
+) -> Iterator[Path]:
+    """Find the files under `source_path` with one of the given extensions."""
+    stack = [str(source_path)]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(extensions) and entry.is_file():
+                    yield Path(entry.path)
+
+
+def write_exports(
+    notebook: NotebookNode,
+    source_filename: Union[str, Path],
+    config: ImplectusConfiguration,
+    executor: Executor = None,
+    export_code=True,
+    export_doc=True,
+):
+    """Write the code and documentation for the given source file together.
+
+    Both destinations are checked before anything is written, and they are replaced
+    together, so an error leaves neither of them changed.
+
+    Args:
+        notebook: The notebook to write.
+        source_filename: Full path of the file from which notebook was read.
+        config: The Implectus configuration.
+        executor: If given, write the files on this executor and return the resulting
+            future (the outputs are still rendered and checked before returning).
+        export_code: Whether to write the code (if config.code_dir is set).
+        export_doc: Whether to write the documentation (if config.doc_dir is set).
+
+    Raises:
+        DestinationNotOverwriteableError: if either destination exists and wasn't
+            generated by Implectus.
+    """
+    renderers = []
+    if export_code and config.code_dir:
+        renderers.append((config.code_path_for_source(source_filename), writes_code))
+    if export_doc and config.doc_dir:
+        renderers.append((config.doc_path_for_source(source_filename), writes_doc))
+    # TODO: check these don't overwrite the source or each other
+    for path, _ in renderers:
+        assert_overwriteable(path)
+    files = [
+        (path, render(notebook, source_filename, config)) for path, render in renderers
+    ]
+    if executor is not None:
+        return executor.submit(write_files, files)
+    return write_files(files)
+
+
+def _export(
+    source: Path, config: ImplectusConfiguration, executor: Executor = None
+) -> List:
+    """Export code and doc for a single source notebook.
+
+    Returns: the futures for the file writes if `executor` was given.
+    """
+    nb = jupytext.read(source)
+    return [write_exports(nb, source, config, executor=executor)]
+
+
+def _export_with_config_values(source: Path, config_values: dict):
+    """Reconstruct the configuration and export a source (runs in a worker)."""
+    _export(source, ImplectusConfiguration(**config_values))
+
+
+def _export_all(
+    sources: List[Path], config: ImplectusConfiguration, max_workers: Optional[int]
+):
+    """Export code and doc for the given source notebooks."""
+    if max_workers == 1 or len(sources) < 2:
+        # Write the output files in the background while parsing the next notebook
+        with ThreadPoolExecutor(max_workers=4) as writer:
+            futures = concat(_export(source, config, writer) for source in sources)
+        for future in futures:
+            # Re-raise any exceptions from the writer threads
+            future.result()
+        return
+
+    # Traitlets objects don't pickle, so send the trait values to the workers
+    values = config_values(config)
+    # Don't start more processes than there are notebooks to export
+    max_workers = min(len(sources), max_workers or os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers) as executor:
+        # Consume the results to re-raise any exceptions from the workers
+        list(
+            executor.map(_export_with_config_values, sources, itertools.repeat(values))
+        )
+
+
+# Records the state of each source and its outputs after the last sync, so that
+# unchanged sources can be skipped
+SYNC_MANIFEST_FILENAME = ".implectus_cache"
+
+
+def _hash_file(path: Union[str, Path]) -> Optional[str]:
+    """Hash a file's contents, or return None if it doesn't exist."""
+    try:
+        content = Path(path).read_bytes()
+    except FileNotFoundError:
+        return None
+    return hashlib.blake2b(content, digest_size=16).hexdigest()
+
+
+def _output_paths(source: Path, config: ImplectusConfiguration) -> List[Path]:
+    paths = []
+    if config.code_dir:
+        paths.append(config.code_path_for_source(source))
+    if config.doc_dir:
+        paths.append(config.doc_path_for_source(source))
+    return paths
+
+
+def _manifest_state(path: Union[str, Path]) -> Optional[dict]:
+    """Describe a file's current state, or return None if it doesn't exist.
+
+    The modification time is left out if the file was modified too recently for its
+    timestamps to show further changes, so that it's checked by hash instead.
+    """
+    # Hash before statting, so a change in between makes the file look stale
+    hash_ = _hash_file(path)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    mtime_ns = st.st_mtime_ns if is_settled(file_state(st)) else None
+    return dict(mtime_ns=mtime_ns, size=st.st_size, hash=hash_)
+
+
+# Returned by _check_unchanged for a file which has changed
+_CHANGED = object()
+
+
+def _check_unchanged(path: Union[str, Path], state: Optional[dict]):
+    """Check whether a file is in the state given by _manifest_state.
+
+    Returns: the file's state (with its modification time filled in, if it's been
+        checked by hash and has settled since), or _CHANGED.
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None if state is None else _CHANGED
+    if not isinstance(state, dict):
+        return _CHANGED
+    if (st.st_mtime_ns, st.st_size) == (state.get("mtime_ns"), state.get("size")):
+        return state
+    # Only hash the file if it looks like it's changed
+    if st.st_size != state.get("size") or _hash_file(path) != state.get("hash"):
+        return _CHANGED
+    # The hash matched, so record the modification time from before hashing (if it's
+    # trustworthy) so that the next sync doesn't need to hash the file again
+    if is_settled(file_state(st)):
+        return dict(state, mtime_ns=st.st_mtime_ns)
+    return state
+
+
+def _manifest_entry(
+    source_state: Optional[dict], config_fingerprint: str, outputs: Iterable[Path]
+):
+    """Describe the state of a source before it was exported, and its outputs now."""
+    return dict(
+        # The source could be deleted during the sync, in which case it'll be stale
+        source_state or {},
+        config=config_fingerprint,
+        outputs={str(path): _manifest_state(path) for path in outputs},
+    )
+
+
+def _check_up_to_date(
+    source: Path, entry: Optional[dict], config_fingerprint: str
+) -> Optional[dict]:
+    """Check whether a source and its outputs are unchanged since the last sync.
+
+    Returns: the source's manifest entry, with any states refreshed by
+        _check_unchanged, or None if it's stale.
+    """
+    if not entry or entry.get("config") != config_fingerprint:
+        return None
+    source_state = _check_unchanged(source, entry)
+    if source_state is _CHANGED:
+        return None
+    outputs = {}
+    for path, state in entry["outputs"].items():
+        outputs[path] = _check_unchanged(path, state)
+        if outputs[path] is _CHANGED:
+            return None
+    return dict(source_state, outputs=outputs)
+
+
+def _is_valid_entry(entry) -> bool:
+    """Check a manifest entry has the shape _manifest_entry gives it."""
+    return isinstance(entry, dict) and isinstance(entry.get("outputs"), dict)
+
+
+def _load_manifest(path: Path) -> Dict[str, dict]:
+    """Load the sync manifest, leaving out any entries that aren't valid."""
+    try:
+        with path.open(encoding="utf8") as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+    if not isinstance(manifest, dict):
+        return {}
+    return {
+        source: entry for source, entry in manifest.items() if _is_valid_entry(entry)
+    }
+
+
+def _save_manifest(path: Path, manifest: Dict[str, dict]):
+    temp_path = path.with_name(path.name + ".tmp")
+    with temp_path.open("w", encoding="utf8") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(temp_path, path)
+
+
+def sync(
+    config: ImplectusConfiguration, max_workers: Optional[int] = 1, use_manifest=True,
+):
+    """Export code and doc for each notebook in the source directory.
+
+    Args:
+        config: The Implectus configuration.
+        max_workers: Maximum number of worker processes to export notebooks with, or
+            None to use one per CPU.  If 1 (the default), or if there's only one
+            notebook to export, everything happens in this process.  Worker processes
+            may be started by re-importing the main module, so only use them from a
+            script guarded by ``if __name__ == "__main__"``.
+        use_manifest: Skip notebooks which haven't changed since the last sync (nor have
+            their outputs or the configuration), according to the manifest file in the
+            working directory.
+    """
     if not config.source_dir:
         return
-    sources = [
-        path for path in config.source_path.glob("**/*") if config.should_process(path)
-    ]
+    sources = list(_iter_source_files(config.source_path, _notebook_extensions(config)))
+    if not use_manifest:
+        _export_all(sources, config, max_workers)
+        return
+
+    manifest_path = config.working_path / SYNC_MANIFEST_FILENAME
+    old_manifest = _load_manifest(manifest_path)
+    fingerprint = config_fingerprint(config)
+    manifest = {}
+    stale = []
     for source in sources:
-        nb = jupytext.read(source)
-        if config.code_dir:
-            write_code(nb, source, config)
-        if config.doc_dir:
-            write_doc(nb, source, config)
+        entry = _check_up_to_date(source, old_manifest.get(str(source)), fingerprint)
+        if entry is None:
+            stale.append(source)
+        else:
+            # Sources which no longer exist are dropped
+            manifest[str(source)] = entry
+    # Record the sources' states before reading them, so that a source modified during
+    # the sync doesn't look up to date next time
+    source_states = {source: _manifest_state(source) for source in stale}
+    _export_all(stale, config, max_workers)
+
+    for source in stale:
+        outputs = _output_paths(source, config)
+        manifest[str(source)] = _manifest_entry(
+            source_states[source], fingerprint, outputs
+        )
+    if manifest != old_manifest:
+        _save_manifest(manifest_path, manifest)
 
 
 # TODO: CLI
@@ -1,24 +1,41 @@
+import hashlib
+import json
+import os
 import textwrap
-import unittest.mock as mock
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import Executor, Future, wait
 from functools import partial
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
 
 import jupytext
-import nbformat
 from jupytext.contentsmanager import build_jupytext_contents_manager_class
-from notebook.notebookapp import NotebookApp
+from nbformat import NotebookNode
 from notebook.services.contents.filemanager import FileContentsManager
 from tornado.web import HTTPError
+from traitlets import Bool, Float
 
 from .config import (
     IMPLECTUS_CONFIG_FILES,
     ImplectusConfiguration,
     construct_config,
-    find_global_config,
     load_config_file,
     validate_config,
 )
-from .main import write_code, write_doc
-from .util import DestinationNotOverwriteableError
+from .export_code import should_export
+from .main import write_exports
+from .util import (
+    DestinationNotOverwriteableError,
+    config_fingerprint,
+    file_state,
+    is_settled,
+    shallow_nb_from_dict,
+)
+
+if TYPE_CHECKING:
+    from notebook.notebookapp import NotebookApp
 
 __all__ = [
     "ImplectusContentsManager",
@@ -26,6 +43,97 @@ __all__ = [
 ]
 
 
+# Number of directories to cache configurations for
+_CONFIG_CACHE_SIZE = 256
+# How long to cache the configuration for directories with no config file (s)
+_CONFIG_CACHE_TTL = 2
+_config_cache_lock = threading.Lock()
+# The path get_config is currently looking up on this thread
+_config_lookup = threading.local()
+
+
+def _dump_json(value) -> bytes:
+    return json.dumps(value, sort_keys=True).encode()
+
+
+def _export_input_hashes(
+    notebook: NotebookNode, hash_code: bool, hash_doc: bool
+) -> Tuple[Optional[bytes], Optional[bytes]]:
+    """Hash the parts of a notebook that its exported code and docs depend on.
+
+    The code depends on the notebook metadata and the exported cells, and the docs
+    depend on all of the notebook.  Each cell is serialised once and fed to both
+    hashes, rather than serialising the whole notebook again for the docs.
+
+    Returns: the code and doc hashes, or None for the ones that weren't asked for.
+    """
+    code_hash = hashlib.blake2b(digest_size=16)
+    doc_hash = hashlib.blake2b(digest_size=16)
+    code_hash.update(_dump_json(notebook.metadata))
+    if hash_doc:
+        doc_hash.update(
+            _dump_json(
+                {key: value for key, value in notebook.items() if key != "cells"}
+            )
+        )
+    for cell in notebook.cells:
+        cell_input = _dump_json((cell.cell_type, cell.source, cell.metadata))
+        if hash_code and should_export(cell):
+            code_hash.update(cell_input)
+        if hash_doc:
+            doc_hash.update(cell_input)
+            # Outputs, attachments and so on
+            doc_hash.update(
+                _dump_json(
+                    {
+                        key: value
+                        for key, value in cell.items()
+                        if key not in ("cell_type", "source", "metadata")
+                    }
+                )
+            )
+    return (
+        code_hash.digest() if hash_code else None,
+        doc_hash.digest() if hash_doc else None,
+    )
+
+
+class _DelayedExecutor(Executor):
+    """Runs each call on its own thread after a delay, unless it's cancelled first."""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+
+    def submit(self, fn, *args, **kwargs):
+        future: Future = Future()
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+        timer = threading.Timer(self.delay, run)
+        timer.name = "implectus-export"
+        timer.start()
+        return future
+
+
+class _GuardedExecutor(Executor):
+    """Submits calls to another executor, running each one through a guard function."""
+
+    def __init__(self, executor: Executor, guard):
+        self.executor = executor
+        self.guard = guard
+
+    def submit(self, fn, *args, **kwargs):
+        return self.executor.submit(self.guard, fn, *args, **kwargs)
+
+
 class ImplectusContentsManager(
     jupytext.TextFileContentsManager,
     FileContentsManager,  # Help type deduction, since Jupytext hides its base
@@ -39,6 +147,149 @@ class ImplectusContentsManager(
     Jupyter Contents API documentation.
     """
 
+    export_in_background = Bool(
+        True,
+        help="Write exported code and documentation on a background thread, so that "
+        "saving doesn't wait for them.  Errors are logged.",
+        config=True,
+    )
+
+    export_delay = Float(
+        0.25,
+        help="How long to wait before writing exports in the background (in seconds). "
+        "If the notebook is saved again in the meantime, only the latest save is "
+        "exported.",
+        config=True,
+    )
+
+    def __init__(self, *args, **kwargs):
+        # Cached configuration for each directory (see get_config)
+        self._config_cache: "OrderedDict[str, tuple]" = OrderedDict()
+        # Created when first needed (see _get_export_executor)
+        self._export_executor: Optional[_DelayedExecutor] = None
+        # The pending export futures for each source path
+        self._pending_exports: Dict[str, List[Future]] = {}
+        # A token for the latest export of each source path
+        self._export_tokens: Dict[str, object] = {}
+        # Held while checking the export token and writing exports
+        self._export_lock = threading.Lock()
+        # The config fingerprint and input hashes of each file's last export
+        self._export_hashes: Dict[
+            str, Tuple[str, Optional[bytes], Optional[bytes]]
+        ] = {}
+        self._parent___init__(*args, **kwargs)
+
+    def _get_export_executor(self) -> Optional[Executor]:
+        """Return the executor to write exports on (created when first needed)."""
+        if not self.export_in_background:
+            return None
+        executor = self._export_executor
+        if executor is None or executor.delay != self.export_delay:
+            executor = _DelayedExecutor(self.export_delay)
+            self._export_executor = executor
+        return executor
+
+    def _write_if_latest(self, relative_path, token, write, *args):
+        """Write a background export, unless a later save has superseded it."""
+        with self._export_lock:
+            if self._export_tokens.get(relative_path) is not token:
+                return None
+            return write(*args)
+
+    def wait_for_exports(self):
+        """Wait for all background exports to finish."""
+        pending = self._pending_exports
+        while pending:
+            wait(pending.popitem()[1])
+
+    def _supersede_exports(self, relative_path):
+        """Cancel the background exports of the given source file.
+
+        Exports which have already started are left to finish; they don't write
+        anything once a later export has started (see _write_if_latest).
+
+        Returns: whether any of the exports hadn't finished.
+        """
+        futures = self._pending_exports.pop(relative_path, [])
+        self._export_tokens[relative_path] = object()
+        for future in futures:
+            # Cancel exports which haven't started yet, since they're out of date
+            future.cancel()
+        return not all(future.done() and not future.cancelled() for future in futures)
+
+    def _export_done(self, relative_path, future: Future):
+        """Log an error from a background export."""
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            self.log.error("[Implectus] Exporting %s failed: %s", relative_path, error)
+            # Write everything again on the next save
+            self._export_hashes.pop(relative_path, None)
+
+    def _export(self, content: dict, relative_path: str, config):
+        """Export the code and docs for a notebook that's being saved."""
+        # Make sure the previous save's exports can't overwrite this one's, and don't
+        # trust its hashes unless it finished
+        hashes = self._export_hashes
+        if self._supersede_exports(relative_path):
+            hashes.pop(relative_path, None)
+        token = self._export_tokens[relative_path]
+
+        nb = shallow_nb_from_dict(content)
+        # Skip exports whose input hasn't changed since they were last written
+        last_fingerprint, last_code_hash, last_doc_hash = hashes.pop(
+            relative_path, (None, None, None)
+        )
+        fingerprint = config_fingerprint(config)
+        code_hash, doc_hash = _export_input_hashes(
+            nb, bool(config.code_dir), bool(config.doc_dir)
+        )
+        export_code = bool(config.code_dir) and not (
+            fingerprint == last_fingerprint
+            and code_hash == last_code_hash
+            and config.code_path_for_source(relative_path).exists()
+        )
+        export_doc = bool(config.doc_dir) and not (
+            fingerprint == last_fingerprint
+            and doc_hash == last_doc_hash
+            and config.doc_path_for_source(relative_path).exists()
+        )
+        if export_code:
+            self.log.info("[Implectus] Saving code for %s", relative_path)
+        if export_doc:
+            self.log.info("[Implectus] Saving docs for %s", relative_path)
+        executor = self._get_export_executor()
+        try:
+            if executor is None:
+                with self._export_lock:
+                    future = write_exports(
+                        nb,
+                        relative_path,
+                        config,
+                        export_code=export_code,
+                        export_doc=export_doc,
+                    )
+            else:
+                future = write_exports(
+                    nb,
+                    relative_path,
+                    config,
+                    executor=_GuardedExecutor(
+                        executor, partial(self._write_if_latest, relative_path, token)
+                    ),
+                    export_code=export_code,
+                    export_doc=export_doc,
+                )
+        except DestinationNotOverwriteableError as e:
+            raise HTTPError(
+                400, f"Implectus could not export to {e.filename} (it exists)"
+            )
+        hashes[relative_path] = (fingerprint, code_hash, doc_hash)
+        if future is not None:
+            self._pending_exports[relative_path] = [future]
+            future.add_done_callback(partial(self._export_done, relative_path))
+
     def save(self, model: dict, path=""):
         """Save the file model and return the model with no content.
 
@@ -52,60 +303,102 @@ class ImplectusContentsManager(
             config = self.get_config(relative_path)
             self.validate_config()
             if config.should_process(relative_path):
-                nb = nbformat.from_dict(model["content"])
-                # TODO: check these don't overwrite each other
-                try:
-                    if config.code_dir:
-                        self.log.info("[Implectus] Saving code for %s" % relative_path)
-                        write_code(nb, relative_path, config)
-                    if config.doc_dir:
-                        self.log.info("[Implectus] Saving docs for %s" % relative_path)
-                        write_doc(nb, relative_path, config)
-                except DestinationNotOverwriteableError as e:
-                    raise HTTPError(
-                        400, f"Implectus could not export to {e.filename} (it exists)"
-                    )
+                self._export(model["content"], relative_path, config)
 
-        # TODO: why doesn't super work after re-deriving?
-        return super(type(self), self).save(model, path)
+        return self._parent_save(model, path)
 
     def get_config_file(self, directory):
-        """Return the jupytext configuration file for the given dir, if any."""
-        # TODO: doc
-        with mock.patch.multiple(
-            "jupytext.contentsmanager",
-            JUPYTEXT_CONFIG_FILES=IMPLECTUS_CONFIG_FILES,
-            find_global_jupytext_configuration_file=find_global_config,
-        ):
-            return super(type(self), self).get_config_file(directory)
+        """Return the Implectus or Jupytext config file for the given dir, if any."""
+        # Same as Jupytext's, but looking for Implectus config files too
+        while True:
+            for filename in IMPLECTUS_CONFIG_FILES:
+                path = directory + "/" + filename
+                if self.file_exists(path):
+                    return path
+            if not directory:
+                return None
+            directory = self.get_parent_dir(directory)
 
     def _load_config_file(self, parent_dir, config_file):
         """Load the configuration file"""
         # TODO: doc
-        with mock.patch.multiple(
-            "jupytext.contentsmanager",
-            load_jupytext_configuration_file=load_config_file,
-            validate_jupytext_configuration_file=construct_config,
-        ):
-            config = super(type(self), self).load_config_file(config_file)
+        # Same as Jupytext's load_config_file, but using Implectus' loader
+        if config_file is None:
+            return None
+        self.log.info("[Implectus] Loading configuration file at %s", config_file)
+        if config_file.endswith(".py"):
+            config_dict = load_config_file(self._get_os_path(config_file))
+        else:
+            model = self.super.get(config_file, content=True, type="file")
+            config_dict = load_config_file(config_file, model["content"])
+        config = construct_config(config_file, config_dict)
         if config:
             return validate_config(parent_dir, config_file, config)
 
-    def load_config_file(self, config_file):
-        """Placeholder that get_config replaces."""
-        raise NotImplementedError()
+    def load_config_file(self, config_file, *args, **kwargs):
+        """Load a configuration file for the path get_config is looking up."""
+        path = getattr(_config_lookup, "path", None)
+        if path is None:
+            raise NotImplementedError("Only get_config can load config files")
+        return self._load_config_file(path, config_file)
+
+    def _config_file_state(self, config_file):
+        """Return the state of a config file (see util.file_state), or None."""
+        try:
+            return file_state(os.stat(self._get_os_path(config_file)))
+        except (OSError, ValueError, HTTPError):
+            return None
 
     def get_config(self, path, *args, **kwargs):
-        """Return the Implectus configuration for the given API path."""
-        # Pass path into _load_config_file for validation
+        """Return the Implectus configuration for the given API path.
+
+        Configurations are cached for each directory until the config file that applies
+        to it changes.  A config file modified in the last couple of seconds is read
+        again every time, since a further change might not show up in its timestamps.
+        When no config file applies, the configuration is cached for a couple of
+        seconds (in case one is created).
+        """
+        parent_dir = self.get_parent_dir(path)
+        config_file = self.get_config_file(parent_dir)
+        state = self._config_file_state(config_file) if config_file else None
+        cache = self._config_cache
+        with _config_cache_lock:
+            entry = cache.get(parent_dir)
+            if entry is not None:
+                cached_file, cached_state, settled, expiry, config = entry
+                if (
+                    cached_file == config_file
+                    and cached_state == state
+                    and (settled if config_file else time.monotonic() < expiry)
+                ):
+                    cache.move_to_end(parent_dir)
+                    return config
+
+        # Check whether the file had settled before reading it, not after
+        settled = is_settled(state)
+        config = self._get_config_uncached(path, *args, **kwargs)
+        with _config_cache_lock:
+            cache[parent_dir] = (
+                config_file,
+                state,
+                settled,
+                time.monotonic() + _CONFIG_CACHE_TTL,
+                config,
+            )
+            cache.move_to_end(parent_dir)
+            while len(cache) > _CONFIG_CACHE_SIZE:
+                cache.popitem(last=False)
+        return config
+
+    def _get_config_uncached(self, path, *args, **kwargs):
+        """Load the Implectus configuration for the given API path."""
+        # Pass path into load_config_file for validation
+        old_path = getattr(_config_lookup, "path", None)
+        _config_lookup.path = path
         try:
-            old_load_config_file = self.load_config_file
-            patched_load_config_file = partial(self._load_config_file, path)
-            # https://github.com/python/mypy/issues/2427
-            self.load_config_file = patched_load_config_file  # type: ignore
-            config = super(type(self), self).get_config(path, *args, **kwargs)
+            config = self._parent_get_config(path, *args, **kwargs)
         finally:
-            self.load_config_file = old_load_config_file  # type: ignore
+            _config_lookup.path = old_path
         if config and config.working_path.is_absolute():
             # TODO: is this still true?
             # get_config uses an absolute path, so the path that ends up in working_dir
@@ -115,33 +408,49 @@ class ImplectusContentsManager(
         return config
 
 
+def _set_parent_methods(contents_manager_class: type, base_class: type):
+    """Store the base class' implementations of the methods ImplectusContentsManager
+    overrides.
+
+    The methods can't use super(), since the __class__ they would use is always
+    ImplectusContentsManager rather than the class built from its __dict__.
+    """
+    for name in ("__init__", "save", "get_config"):
+        setattr(contents_manager_class, "_parent_" + name, getattr(base_class, name))
+
+
+_set_parent_methods(ImplectusContentsManager, jupytext.TextFileContentsManager)
+
+
 def build_implectus_contents_manager_class(base_class: type):
     """Derives a contents manager from the given base class.
 
     Jupytext does it this way so that it doesn't break applications with a different
     default contents manager.
     """
-    return type(
+    contents_manager_class = type(
         "ImplectusContentsManager",
         (base_class, ImplectusConfiguration),
         dict(ImplectusContentsManager.__dict__),
     )
+    _set_parent_methods(contents_manager_class, base_class)
+    return contents_manager_class
 
 
-def replace_contents_manager(app: NotebookApp):
+def replace_contents_manager(app: "NotebookApp"):
     """Replace the app's contents manager with ours."""
     if not hasattr(app.contents_manager_class, "default_jupytext_formats"):
         app.log.debug(
-            "[Implectus] Building Jupytext contents manager "
-            f"from {app.contents_manager_class.__name__}"
+            "[Implectus] Building Jupytext contents manager from %s",
+            app.contents_manager_class.__name__,
         )
         app.contents_manager_class = build_jupytext_contents_manager_class(
             app.contents_manager_class
         )
 
     app.log.debug(
-        "[Implectus] Building Implectus contents manager "
-        f"from {app.contents_manager_class.__name__}"
+        "[Implectus] Building Implectus contents manager from %s",
+        app.contents_manager_class.__name__,
     )
     contents_manager_class = build_implectus_contents_manager_class(
         app.contents_manager_class
@@ -155,14 +464,21 @@ def replace_contents_manager(app: NotebookApp):
     app.log.info("[Implectus] Contents manager set up successfully")
 
 
+# Apps the server extension has already been loaded into
+_loaded_apps: "weakref.WeakSet[NotebookApp]" = weakref.WeakSet()
+
+
 def load_jupyter_server_extension(app):
     """Use Implectus' content manager in the Jupyter notebook server.
 
     Called by the server during startup if the Implectus server extension is enabled.
     """
-    if hasattr(app.contents_manager_class, "TODO"):
+    if app in _loaded_apps or issubclass(
+        app.contents_manager_class, ImplectusConfiguration
+    ):
         app.log.info("[Implectus] Implectus contents manager already loaded")
         return
+    _loaded_apps.add(app)
 
     # The contents manager has already been initialised in
     # notebook.NotebookApp.init_configurables, so we have to replace it (see
@@ -1,14 +1,63 @@
 """Utility functions."""
+import hashlib
 import itertools
+import json
+import os
 import re
+import shutil
 import textwrap
+import threading
+import time
 from pathlib import Path
+from typing import TYPE_CHECKING, Iterable, List, Optional, Tuple, Union
 
 import jupytext
+import nbformat
 from nbformat import NotebookNode
 
 from .__about__ import __version__
 
+if TYPE_CHECKING:
+    from .config import ImplectusConfiguration
+
+
+# Timestamps are only this precise on some filesystems (FAT has 2s resolution), so a
+# file modified more recently than this could change again without its mtime changing
+TIMESTAMP_RESOLUTION_NS = 2 * 10 ** 9
+
+FileState = Tuple[int, int, int, int, int]
+
+
+def file_state(st: os.stat_result) -> FileState:
+    """Summarize a stat result for detecting changes to a file or directory."""
+    return st.st_dev, st.st_ino, st.st_mtime_ns, st.st_ctime_ns, st.st_size
+
+
+def is_settled(state: Optional[FileState]) -> bool:
+    """Check whether a file's state is old enough to detect any further changes."""
+    if state is None:
+        return True
+    age = int(time.time() * 10 ** 9) - max(state[2], state[3])
+    return age >= TIMESTAMP_RESOLUTION_NS
+
+
+def config_values(config: "ImplectusConfiguration") -> dict:
+    """Return the values needed to reconstruct a configuration."""
+    return dict(config.trait_values(config=True), working_dir=config.working_dir)
+
+
+def config_fingerprint(config: "ImplectusConfiguration") -> str:
+    """Hash a configuration, so that changing it invalidates anything exported with it.
+
+    The Implectus version is included too, since it's written into the outputs.
+    """
+    values = json.dumps(
+        dict(config_values(config), implectus_version=__version__),
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.blake2b(values.encode(), digest_size=16).hexdigest()
+
 
 def nb_cell(cell_type: str, source="", metadata: dict = None, **kwargs):
     """Construct a Jupyter notebook cell.
@@ -19,10 +68,39 @@ def nb_cell(cell_type: str, source="", metadata: dict = None, **kwargs):
         metadata: Metadata dictionary.
         **kwargs: Additional metadata.
     """
-    metadata = dict(metadata or {}, **kwargs)
+    # kwargs is a fresh dict, so it can be used as the metadata without copying
+    metadata = dict(metadata, **kwargs) if metadata else kwargs
     return NotebookNode(cell_type=cell_type, metadata=metadata, source=source)
 
 
+def cell_tags(cell) -> frozenset:
+    """Return the set of tags on a notebook cell."""
+    tags = cell.metadata.get("tags")
+    return frozenset(tags) if tags else frozenset()
+
+
+def shallow_nb_from_dict(content: dict) -> NotebookNode:
+    """Wrap a notebook dict so it can be exported, without converting all of it.
+
+    Unlike `nbformat.from_dict`, only the notebook, its metadata, and the cells and
+    their metadata are converted to `NotebookNode` (which is all the exporters use
+    attribute access on); outputs and attachments are left as they are.  Outputs are
+    converted by `jupytext_writes` if they end up being written to an ipynb file.
+
+    If `content` is already a `NotebookNode`, it's returned as it is.
+    """
+    if isinstance(content, NotebookNode):
+        return content
+    nb = NotebookNode(content)
+    nb.metadata = NotebookNode(content.get("metadata", {}))
+    nb.cells = []
+    for cell in content.get("cells", []):
+        cell = NotebookNode(cell)
+        cell.metadata = NotebookNode(cell.get("metadata", {}))
+        nb.cells.append(cell)
+    return nb
+
+
 _implectus_header_template = textwrap.dedent(
     """\
     # Autogenerated from `{filename}`
@@ -30,35 +108,108 @@ _implectus_header_template = textwrap.dedent(
     edit `{filename}` instead."""
 )
 _implectus_header_re = re.compile(
-    _implectus_header_template.replace(".", r"\.").format(
+    r"\A"
+    + _implectus_header_template.replace(".", r"\.").format(
         filename=r"([^\n]*?)", version=r"([\w\.\-]*?)"
     )
 )
 
 
+# The header with the version filled in, split around the filenames
+_implectus_header_parts = _implectus_header_template.replace(
+    "{version}", __version__
+).split("{filename}")
+_implectus_header_prefix = _implectus_header_parts[0]
+
+
 def implectus_header_cell(filename):
     """Generate an Implectus 'autogenerated from' header cell."""
-    text = _implectus_header_template.format(filename=filename, version=__version__)
-    return nb_cell("markdown", text)
+    return nb_cell("markdown", str(filename).join(_implectus_header_parts))
+
+
+# The header should be well within this many bytes from the start of any format
+_implectus_header_search_size = 4096
 
 
 def is_implectus_header_cell(cell: NotebookNode):
     """Check if a cell is an Implectus header cell."""
-    return cell.cell_type == "markdown" and _implectus_header_re.match(cell.source)
+    return (
+        cell.cell_type == "markdown"
+        and cell.source.startswith(_implectus_header_prefix)
+        and _implectus_header_re.match(cell.source) is not None
+    )
+
+
+_ipynb_first_cell_re = re.compile(r'^\s*\{\s*"cells"\s*:\s*\[\s*')
+
+
+def _first_cell_from_start(filename, start: str, complete: bool):
+    """Parse the first cell of a notebook from the start of the file.
+
+    Args:
+        filename: The notebook's filename (to determine its format).
+        start: The start of the file.
+        complete: Whether `start` is the whole file.
+
+    Returns: The first cell, or None if it isn't all in `start`.
+    """
+    extension = os.path.splitext(str(filename))[1]
+    if extension == ".ipynb":
+        # nbformat sorts keys, so the cells come first
+        match = _ipynb_first_cell_re.match(start)
+        if not match:
+            return None
+        try:
+            cell, _ = json.JSONDecoder().raw_decode(start, match.end())
+        except ValueError:
+            return None
+        if not isinstance(cell, dict):
+            return None
+        cell = NotebookNode(cell)
+        if isinstance(cell.get("source"), list):
+            cell.source = "".join(cell.source)
+        return cell
+    if not complete:
+        # Drop the last line, which might be cut off.  If the whole header is still
+        # there then so is the first cell, whether or not it's the header.
+        start = start[: start.rfind("\n") + 1]
+        if _implectus_header_parts[-1] not in start:
+            return None
+    try:
+        nb = jupytext.reads(start, fmt=extension)
+    except Exception:
+        return None
+    return nb.cells[0] if nb.cells else None
 
 
 def is_autogenerated(filename):
     """Check if a notebook was generated by Implectus."""
+    try:
+        # Most files can be ruled out or confirmed from the start of the file
+        with open(filename, "rb") as f:
+            start = f.read(_implectus_header_search_size)
+    except OSError:
+        return False
+    # Leave out the "# ", since how the heading is written depends on the format
+    if _implectus_header_prefix[2:].encode() not in start:
+        return False
+    complete = len(start) < _implectus_header_search_size
+    cell = _first_cell_from_start(
+        filename, start.decode("utf8", errors="ignore"), complete
+    )
+    if cell is not None:
+        return is_implectus_header_cell(cell)
     try:
         nb = jupytext.read(filename)
         return is_implectus_header_cell(nb.cells[0])
-    except (ValueError, FileNotFoundError):
+    except (ValueError, FileNotFoundError, IndexError):
         return False
 
 
 class DestinationNotOverwriteableError(RuntimeError):
     def __init__(self, filename: str):
-        super().__init__()
+        # Pass filename on so that it's pickled too (for worker processes)
+        super().__init__(filename)
         self.filename = filename
 
 
@@ -71,9 +222,110 @@ def assert_overwriteable(filename):
         raise DestinationNotOverwriteableError(filename)
 
 
+def _has_content(path: Path, content: str):
+    """Check whether the file at `path` already contains exactly `content`."""
+    try:
+        with path.open(encoding="utf8") as f:
+            # Don't bother reading (or decoding) more than necessary
+            existing = f.read(len(content) + 1)
+    except (OSError, UnicodeDecodeError):
+        return False
+    return existing == content
+
+
+def write_file(filename, content: str):
+    """Write `content` to `filename`, creating parent directories as necessary.
+
+    If the file already has that content it is left alone, so that its modification
+    time doesn't change.
+    """
+    write_files([(filename, content)])
+
+
+def _unlink_if_exists(filename):
+    try:
+        os.unlink(filename)
+    except FileNotFoundError:
+        pass
+
+
+def _sibling_filename(filename: str, kind: str):
+    """Return a filename next to `filename` for a temporary or backup file."""
+    return f"{filename}.{kind}.{os.getpid()}.{threading.get_ident()}"
+
+
+def _write_temp_file(filename: str, content: str):
+    """Write `content` to a temporary file next to `filename` and return its name."""
+    temp_filename = _sibling_filename(filename, "tmp")
+    try:
+        with open(temp_filename, "w", encoding="utf8", buffering=1 << 20) as f:
+            f.write(content)
+        try:
+            # Keep the permissions of the file being replaced
+            shutil.copymode(filename, temp_filename)
+        except FileNotFoundError:
+            pass
+    except BaseException:
+        _unlink_if_exists(temp_filename)
+        raise
+    return temp_filename
+
+
+def _backup(filename: str) -> Optional[str]:
+    """Keep a copy of `filename` (as a hard link if possible), if it exists."""
+    if not os.path.exists(filename):
+        return None
+    backup_filename = _sibling_filename(filename, "bak")
+    try:
+        os.link(filename, backup_filename)
+    except OSError:
+        shutil.copy2(filename, backup_filename)
+    return backup_filename
+
+
+def write_files(files: Iterable[Tuple[Union[str, Path], str]]):
+    """Write several files at once, so that either all of them change or none do.
+
+    Each file is written like `write_file`.  If replacing one of the files fails, the
+    ones already replaced are restored.
+
+    Args:
+        files: Pairs of filename and content.
+    """
+    changed = [
+        (str(filename), content)
+        for (filename, content) in files
+        if not _has_content(Path(filename), content)
+    ]
+    temp_filenames = []
+    backup_filenames: List[Optional[str]] = []
+    try:
+        for filename, content in changed:
+            Path(filename).parent.mkdir(parents=True, exist_ok=True)
+            temp_filenames.append(_write_temp_file(filename, content))
+        if len(changed) == 1:
+            os.replace(temp_filenames[0], changed[0][0])
+            return
+        try:
+            for (filename, _), temp_filename in zip(changed, temp_filenames):
+                backup_filenames.append(_backup(filename))
+                os.replace(temp_filename, filename)
+        except BaseException:
+            for (filename, _), backup_filename in zip(changed, backup_filenames):
+                if backup_filename is None:
+                    _unlink_if_exists(filename)
+                else:
+                    os.replace(backup_filename, filename)
+            raise
+    finally:
+        for filename in itertools.chain(temp_filenames, backup_filenames):
+            if filename is not None:
+                _unlink_if_exists(filename)
+
+
 def concat(iterable):
     """Concatenate each element in an iterable of iterables into a list."""
-    return list(itertools.chain(*iterable))
+    return list(itertools.chain.from_iterable(iterable))
 
 
 def is_private(name):
@@ -81,6 +333,20 @@ def is_private(name):
     return name.startswith("_")
 
 
+def _with_converted_outputs(notebook: NotebookNode) -> NotebookNode:
+    """Convert any outputs left as plain dicts by `shallow_nb_from_dict`."""
+    cells = []
+    for cell in notebook.cells:
+        outputs = cell.get("outputs")
+        if outputs and not all(isinstance(output, NotebookNode) for output in outputs):
+            cell = NotebookNode(cell)
+            cell.outputs = [nbformat.from_dict(output) for output in outputs]
+        cells.append(cell)
+    notebook = NotebookNode(notebook)
+    notebook.cells = cells
+    return notebook
+
+
 def jupytext_writes(notebook: NotebookNode, fmt: str, **kwargs):
     """"Write a notebook to a Unicode string in a given Jupytext format.
 
@@ -91,6 +357,9 @@ def jupytext_writes(notebook: NotebookNode, fmt: str, **kwargs):
 
     Returns: The Unicode representation of the notebook, with a trailing newline.
     """
+    if fmt.split(":")[0].endswith("ipynb"):
+        # nbformat uses attribute access on outputs, but only for ipynb
+        notebook = _with_converted_outputs(notebook)
     content = jupytext.writes(notebook, fmt, **kwargs)
     if isinstance(content, bytes):
         content = content.decode("utf8")
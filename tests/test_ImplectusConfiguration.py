@@ -64,6 +64,11 @@ def test_doc_path(doc, root, expected):
         ("notebooks/main.py", "notebooks", "", True),
         ("main.py", "notebooks", "", False),
         ("main.py", ".", "", True),
+        ("./notebooks/main.py", "notebooks", "", True),
+        ("notebooks/module/main.py", "notebooks", "", True),
+        ("notebooks2/main.py", "notebooks", "", False),
+        ("notebooks/../main.py", "notebooks", "", False),
+        ("../main.py", ".", "", False),
         # Absolute paths
         ("/tmp/main.py", "notebooks", "/tmp", False),
         ("/tmp/notebooks/main.py", "notebooks", "/tmp", True),
@@ -85,6 +90,16 @@ def test_should_process(path, source, root, expected):
     assert cfg.should_process(path) == expected
 
 
+def test_should_process_follows_config_changes():
+    cfg = ImplectusConfiguration(source_dir="notebooks")
+    assert cfg.should_process("notebooks/main.py")
+    cfg.source_dir = "src"
+    assert not cfg.should_process("notebooks/main.py")
+    assert cfg.should_process("src/main.py")
+    cfg.working_dir = "project"
+    assert cfg.should_process("project/src/main.py")
+
+
 # TODO: remove this and maintain coverage through public interface
 @pytest.mark.parametrize(
     "path,source,root,expected",
@@ -248,4 +263,25 @@ def test_doc_path_for_source(path, source, doc, expected):
     assert cfg.doc_path_for_source(path) == expected
 
 
+def test_path_methods_follow_config_changes():
+    cfg = ImplectusConfiguration(source_dir="notebooks", code_dir="package")
+    assert cfg.code_path_for_source("notebooks/main.py") == Path("package/main.py")
+    assert cfg.module_name("notebooks/main.py") == "main"
+    cfg.code_dir = "code"
+    cfg.export_code_as_package = True
+    assert cfg.code_path_for_source("notebooks/main.py") == Path("code/main.py")
+    assert cfg.module_name("notebooks/main.py") == "code.main"
+    cfg.code_dir = "src/package"
+    assert cfg.module_name("notebooks/main.py") == "package.main"
+
+
+def test_path_cache_is_bounded(monkeypatch):
+    monkeypatch.setattr("implectus.config._PATH_CACHE_SIZE", 2)
+    cfg = ImplectusConfiguration(source_dir="notebooks", code_dir="package")
+    for name in ("a", "b", "c", "a"):
+        path = cfg.code_path_for_source(f"notebooks/{name}.py")
+        assert path == Path(f"package/{name}.py")
+    assert len(cfg._path_cache) == 2
+
+
 # TODO: test with root path above working directory
@@ -3,42 +3,45 @@
 import os
 from pathlib import Path
 
-import pyfakefs  # noqa: F401
 import pytest
 
-from implectus.config import load_config_for_path
+from implectus.config import ImplectusConfigError, load_config_for_path
 
 from .util import write_config
 
-HOME = os.environ["HOME"]
-
 
 @pytest.mark.parametrize(
     "config_file_path",
     (
         # Not at all exhaustive
-        f"{HOME}/.implectus.toml",
-        f"{HOME}/.implectus.yml",
-        f"{HOME}/.implectus.yaml",
-        f"{HOME}/.implectus.json",
-        # pyfakefs breaks PyFormatLoader
-        # f"{HOME}/.implectus.py",
-        "/usr/share/implectus.yaml",
+        "home/.implectus.toml",
+        "home/.implectus.yml",
+        "home/.implectus.yaml",
+        "home/.implectus.json",
+        "home/.implectus.py",
+        "usr/share/implectus.yaml",
         # These should work too
-        f"{HOME}/.jupytext",
-        f"{HOME}/.jupytext.toml",
-        f"{HOME}/.jupytext.yml",
-        f"{HOME}/.jupytext.yaml",
-        f"{HOME}/.jupytext.json",
-        "/usr/share/jupytext.yaml",
+        "home/.jupytext",
+        "home/.jupytext.toml",
+        "home/.jupytext.yml",
+        "home/.jupytext.yaml",
+        "home/.jupytext.json",
+        "usr/share/jupytext.yaml",
     ),
 )
 @pytest.mark.filterwarnings(
     "ignore:Setting Implectus paths:implectus.config.ImplectusConfigWarning"
 )
-def test_finding_global_config(fs, config_file_path):
-    """Use pyfakefs to test finding global config files."""
-    # TODO: Why is this so slow with pyfakefs??
+def test_finding_global_config(tmpdir_cd, monkeypatch, config_file_path):
+    """Test finding global config files, with the global config dirs moved."""
+    monkeypatch.delenv("XDG_CONFIG_HOME", raising=False)
+    monkeypatch.delenv("USERPROFILE", raising=False)
+    monkeypatch.setenv("HOME", str(tmpdir_cd / "home"))
+    share_dirs = [
+        str(tmpdir_cd / "usr" / "local" / "share"),
+        str(tmpdir_cd / "usr" / "share"),
+    ]
+    monkeypatch.setenv("XDG_CONFIG_DIRS", ":".join(share_dirs))
     write_config(
         config_file_path, dict(source_dir="custom", default_jupytext_formats="custom")
     )
@@ -118,4 +121,66 @@ def test_finding_local_config_for_path(tmpdir, notebook_path):
     _test_finding_local_config(tmpdir, "implectus.yaml", notebook_path)
 
 
+def test_finding_new_local_config(tmpdir):
+    notebook_path = Path(tmpdir) / "notebooks" / "test.py"
+    notebook_path.parent.mkdir()
+    assert load_config_for_path(notebook_path) is None
+
+    write_config(Path(tmpdir) / "implectus.yaml", dict(source_dir="notebooks"))
+    config = load_config_for_path(notebook_path)
+    assert config.source_dir == "notebooks"
+
+
+def test_reloading_changed_local_config(tmpdir):
+    config_path = Path(tmpdir) / "implectus.yaml"
+    write_config(config_path, dict(source_dir="notebooks"))
+    assert load_config_for_path(Path(tmpdir) / "test.py").source_dir == "notebooks"
+
+    write_config(config_path, dict(source_dir="other_notebooks"))
+    config = load_config_for_path(Path(tmpdir) / "test.py")
+    assert config.source_dir == "other_notebooks"
+
+
+def test_reloading_config_changed_without_mtime(tmpdir):
+    config_path = Path(tmpdir) / "implectus.yaml"
+    write_config(config_path, dict(source_dir="notebooks"))
+    mtime_ns = config_path.stat().st_mtime_ns
+    assert load_config_for_path(Path(tmpdir) / "test.py").source_dir == "notebooks"
+
+    # Same size and modification time, as after a quick edit on a coarse filesystem
+    write_config(config_path, dict(source_dir="notebookz"))
+    os.utime(config_path, ns=(mtime_ns, mtime_ns))
+    config = load_config_for_path(Path(tmpdir) / "test.py")
+    assert config.source_dir == "notebookz"
+
+
+def test_finding_global_config_after_home_changes(tmpdir_cd, monkeypatch):
+    # Cache even recently-modified directories, so only the directory list can differ
+    monkeypatch.setattr("implectus.util.TIMESTAMP_RESOLUTION_NS", 0)
+    monkeypatch.delenv("XDG_CONFIG_HOME", raising=False)
+    monkeypatch.delenv("USERPROFILE", raising=False)
+    monkeypatch.setenv("XDG_CONFIG_DIRS", str(tmpdir_cd / "share"))
+    for home in ("home1", "home2"):
+        write_config(f"{home}/.implectus.yaml", dict(default_jupytext_formats=home))
+        os.utime(home, ns=(0, 0))
+
+    monkeypatch.setenv("HOME", str(tmpdir_cd / "home1"))
+    assert load_config_for_path("notebook.py").default_jupytext_formats == "home1"
+    monkeypatch.setenv("HOME", str(tmpdir_cd / "home2"))
+    assert load_config_for_path("notebook.py").default_jupytext_formats == "home2"
+
+
+def test_no_config_for_config_file(tmpdir):
+    config_path = Path(tmpdir) / ".implectus.py"
+    write_config(config_path, dict(source_dir="notebooks"))
+    assert load_config_for_path(config_path) is None
+    assert load_config_for_path(Path(tmpdir) / "test.py").source_dir == "notebooks"
+
+
+def test_invalid_config_option(tmpdir):
+    write_config(Path(tmpdir) / "implectus.yaml", dict(not_an_option="notebooks"))
+    with pytest.raises(ImplectusConfigError, match="not_an_option"):
+        load_config_for_path(Path(tmpdir) / "test.py")
+
+
 # TODO: Jupytext integration tests to make sure it still picks up the config
@@ -1,5 +1,6 @@
 """Unit tests for export_code module."""
 
+import copy
 import textwrap
 
 import jupytext
@@ -7,6 +8,7 @@ import pytest
 
 from implectus.config import ImplectusConfiguration
 from implectus.export_code import (
+    exported_names,
     relative_import,
     relativize_imports,
     should_export,
@@ -117,8 +119,45 @@ class TestRelativizeImports:
         output_cell = relativize_imports(input_cell, "package.parent.module")
         assert output_cell.source == out
 
+    def test_copies_changed_cells(self):
+        input_cell = nb_cell("code", "from package import name")
+        output_cell = relativize_imports(input_cell, "package.module")
+        assert output_cell is not input_cell
+        assert input_cell.source == "from package import name"
+
+        input_cell = nb_cell("code", "import os")
+        assert relativize_imports(input_cell, "package.module") is input_cell
+
+
+class TestExportedNames:
+
+    """Tests for exported_names function."""
+
+    @pytest.mark.parametrize(
+        "source,expected",
+        (
+            ("def hello():\n    pass", [("hello", "function")]),
+            ("async def hello():\n    pass", [("hello", "function")]),
+            ("class Hello:\n    pass", [("Hello", "class")]),
+            ("class Hello(object):\n    pass", [("Hello", "class")]),
+            (
+                "class Hello:\n    def method(self):\n        pass\n\ndef world():\n"
+                "    pass",
+                [("Hello", "class"), ("world", "function")],
+            ),
+            ("def _private():\n    pass\n\nclass _Private:\n    pass", []),
+            ("hello = 1", []),
+        ),
+    )
+    def test_exported(self, source, expected):
+        cell = nb_cell("code", source, tags=["export"])
+        assert exported_names(cell) == expected
 
-# TODO: exported_names
+    def test_not_exported(self):
+        assert exported_names(nb_cell("code", "def hello():\n    pass")) == []
+        assert (
+            exported_names(nb_cell("markdown", "def hello():", tags=["export"])) == []
+        )
 
 
 def test_writes_code():
@@ -166,3 +205,18 @@ def test_writes_code_without_metadata():
         """
     )
     assert code_equal(actual, expected)
+
+
+def test_writes_code_leaves_notebook_unchanged():
+    cfg = ImplectusConfiguration(
+        source_dir=".", code_dir="package", export_code_as_package=True
+    )
+    nb = create_nb(
+        [
+            nb_cell("code", "from package.other import name", tags=["export"]),
+            nb_cell("code", "name()"),
+        ]
+    )
+    original = copy.deepcopy(nb)
+    writes_code(nb, "main.py", cfg)
+    assert nb == original
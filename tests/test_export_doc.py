@@ -1,9 +1,16 @@
+import copy
 import textwrap
 
 import jupytext
 
 from implectus.config import ImplectusConfiguration
-from implectus.export_doc import writes_doc
+from implectus.export_doc import (
+    autodoc_directive_for_name,
+    document_cell,
+    documented_names,
+    writes_doc,
+)
+from implectus.util import nb_cell
 
 from .util import doc_equal
 
@@ -49,3 +56,46 @@ def test_writes_doc():
         """
     )
     assert doc_equal(actual, expected)
+
+
+def test_writes_doc_leaves_notebook_unchanged():
+    cfg = ImplectusConfiguration(source_dir=".", code_dir="package")
+    source = textwrap.dedent(
+        """\
+        # # Title
+
+        # + tags=["export"]
+        def hello():
+            pass
+        """
+    )
+    nb = jupytext.reads(source, fmt="py:light")
+    original = copy.deepcopy(nb)
+    writes_doc(nb, "main.py", cfg)
+    assert nb == original
+
+
+def test_autodoc_directive_for_name():
+    assert (
+        autodoc_directive_for_name("hello", "function") == "```{autofunction} hello```"
+    )
+
+
+def test_document_cell_skips_documented_names():
+    source = (
+        "class Hello:\n    pass\n\ndef hello():\n    pass\n\ndef world():\n    pass"
+    )
+    cell = nb_cell("code", source, tags=["export"])
+    directives, code_cell = document_cell(cell, frozenset({"hello"}))
+    assert directives.source == "```{autoclass} Hello```\n```{autofunction} world```"
+    assert code_cell.metadata["tags"] == ["export", "remove-input"]
+
+
+def test_documented_names():
+    source = (
+        "```{autofunction} hello\n:noindex:\n```\n\n"
+        "Some `inline` code.\n\n"
+        "```{py:class} World(arg)\nA class with an `arg`.\n```"
+    )
+    cell = nb_cell("markdown", source)
+    assert documented_names(cell) == ["hello", "World"]
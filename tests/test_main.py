@@ -1 +1,25 @@
 """Unit tests for main module."""
+
+from pathlib import Path
+
+from implectus.config import ImplectusConfiguration
+from implectus.main import _iter_source_files, _notebook_extensions
+
+
+def test_notebook_extensions():
+    cfg = ImplectusConfiguration(notebook_extensions="ipynb, .py,md")
+    assert _notebook_extensions(cfg) == (".ipynb", ".py", ".md")
+
+
+def test_iter_source_files(tmpdir_cd):
+    for path in ("notebooks/main.py", "notebooks/sub/other.ipynb", "notebooks/a.txt"):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        Path(path).touch()
+    Path("notebooks/empty_dir.py").mkdir()
+    Path("outside.py").touch()
+
+    sources = _iter_source_files("notebooks", (".py", ".ipynb"))
+    assert sorted(sources) == [
+        Path("notebooks/main.py"),
+        Path("notebooks/sub/other.ipynb"),
+    ]
@@ -1,6 +1,7 @@
 """Integration tests for export module."""
 
-import sys
+import importlib.util
+import json
 import textwrap
 from pathlib import Path
 
@@ -8,7 +9,15 @@ import jupytext
 import pytest
 
 from implectus.config import ImplectusConfiguration
-from implectus.main import sync, write_code, write_doc
+from implectus.main import (
+    SYNC_MANIFEST_FILENAME,
+    _hash_file,
+    sync,
+    write_code,
+    write_doc,
+    write_exports,
+)
+from implectus.util import DestinationNotOverwriteableError
 
 from .util import code_equal, doc_equal
 
@@ -76,10 +85,12 @@ def test_write_code(config):
 
     assert code_equal("package/main.py", code)
 
-    sys.path.append(str(config.working_path))
-    import package.main  # noqa: I900
+    # Import the module from its file, without touching sys.path or sys.modules
+    spec = importlib.util.spec_from_file_location("package.main", "package/main.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)  # type: ignore
 
-    assert package.main.hello()
+    assert module.hello()  # type: ignore
 
 
 def test_write_doc(config):
@@ -89,6 +100,26 @@ def test_write_doc(config):
     assert doc_equal("doc/main.ipynb", doc)
 
 
+def test_write_exports(config):
+    nb = jupytext.reads(source, fmt="py:light")
+    write_exports(nb, "notebooks/main.py", config)
+
+    assert code_equal("package/main.py", code)
+    assert doc_equal("doc/main.ipynb", doc)
+
+
+def test_write_exports_not_overwriteable(config):
+    config.doc_path.mkdir()
+    Path("doc/main.ipynb").write_text("Handwritten")
+    nb = jupytext.reads(source, fmt="py:light")
+    with pytest.raises(DestinationNotOverwriteableError):
+        write_exports(nb, "notebooks/main.py", config)
+
+    # Neither file was written
+    assert not Path("package/main.py").exists()
+    assert Path("doc/main.ipynb").read_text() == "Handwritten"
+
+
 def test_sync(config):
     config.source_path.mkdir()
     Path("notebooks/main.py").write_text(source)
@@ -99,4 +130,190 @@ def test_sync(config):
     assert doc_equal("doc/main.ipynb", doc)
 
 
+@pytest.mark.parametrize("max_workers", (1, None))
+def test_sync_multiple(config, max_workers):
+    Path("notebooks/module").mkdir(parents=True)
+    Path("notebooks/main.py").write_text(source)
+    Path("notebooks/module/other.py").write_text(source)
+    sync(config, max_workers)
+
+    assert code_equal("package/main.py", code)
+    other_code = code.replace("notebooks/main.py", "notebooks/module/other.py")
+    assert code_equal("package/module/other.py", other_code)
+    assert doc_equal("doc/main.ipynb", doc)
+    other_doc = doc.replace("notebooks/main.py", "notebooks/module/other.py")
+    other_doc = other_doc.replace("package.main", "package.module.other")
+    assert doc_equal("doc/module/other.ipynb", other_doc)
+
+
+def test_sync_multiple_not_overwriteable(config):
+    Path("notebooks/module").mkdir(parents=True)
+    Path("notebooks/main.py").write_text(source)
+    Path("notebooks/module/other.py").write_text(source)
+    config.code_path.mkdir()
+    Path("package/main.py").write_text("Handwritten file")
+
+    # The error is passed back from the worker process
+    with pytest.raises(DestinationNotOverwriteableError) as e:
+        sync(config, max_workers=None)
+    assert e.value.filename == Path("package/main.py")
+    assert Path("package/main.py").read_text() == "Handwritten file"
+
+
+def _forbid_reading(monkeypatch):
+    def read(*args, **kwargs):
+        raise AssertionError("Notebook should not have been read")
+
+    monkeypatch.setattr("implectus.main.jupytext.read", read)
+
+
+def test_sync_skips_unchanged(config, monkeypatch):
+    config.source_path.mkdir()
+    Path("notebooks/main.py").write_text(source)
+    sync(config)
+
+    with monkeypatch.context() as m:
+        _forbid_reading(m)
+        sync(config)
+    assert code_equal("package/main.py", code)
+    assert doc_equal("doc/main.ipynb", doc)
+
+
+def test_sync_stops_hashing_settled_files(config, monkeypatch):
+    config.source_path.mkdir()
+    Path("notebooks/main.py").write_text(source)
+    # The outputs were just written, so they're recorded without modification times
+    sync(config)
+
+    hashed = []
+
+    def record_hash(path):
+        hashed.append(path)
+        return _hash_file(path)
+
+    monkeypatch.setattr("implectus.main._hash_file", record_hash)
+    # Treat everything as settled from now on
+    monkeypatch.setattr("implectus.util.TIMESTAMP_RESOLUTION_NS", 0)
+    with monkeypatch.context() as m:
+        _forbid_reading(m)
+        sync(config)
+        assert hashed
+        hashed.clear()
+        sync(config)
+    assert not hashed
+
+
+def test_sync_reexports_changed(config):
+    config.source_path.mkdir()
+    Path("notebooks/main.py").write_text(source)
+    sync(config)
+
+    Path("notebooks/main.py").write_text(source.replace("Hello world", "Hi"))
+    Path("doc/main.ipynb").unlink()
+    sync(config)
+    assert code_equal("package/main.py", code.replace("Hello world", "Hi"))
+    assert doc_equal("doc/main.ipynb", doc.replace("Hello world", "Hi"))
+
+
+def test_sync_reexports_modified_output(config):
+    config.source_path.mkdir()
+    Path("notebooks/main.py").write_text(source)
+    sync(config)
+
+    with open("package/main.py", "a") as f:
+        f.write("# Edited\n")
+    sync(config)
+    assert code_equal("package/main.py", code)
+
+
+def test_sync_reexports_when_config_changes(config):
+    config.source_path.mkdir()
+    Path("notebooks/main.py").write_text(source)
+    sync(config)
+
+    config.code_dir = "other_package"
+    sync(config)
+    assert code_equal("other_package/main.py", code)
+
+
+def test_sync_reexports_source_changed_during_export(config, monkeypatch):
+    config.source_path.mkdir()
+    Path("notebooks/main.py").write_text(source)
+    read = jupytext.read
+
+    def read_then_edit(fp, *args, **kwargs):
+        nb = read(fp, *args, **kwargs)
+        Path(fp).write_text(source.replace("Hello world", "Hi"))
+        return nb
+
+    with monkeypatch.context() as m:
+        m.setattr("implectus.main.jupytext.read", read_then_edit)
+        sync(config)
+    assert code_equal("package/main.py", code)
+
+    sync(config)
+    assert code_equal("package/main.py", code.replace("Hello world", "Hi"))
+
+
+def test_sync_reexports_when_version_changes(config, monkeypatch):
+    config.source_path.mkdir()
+    Path("notebooks/main.py").write_text(source)
+    sync(config)
+
+    monkeypatch.setattr("implectus.util.__version__", "999")
+    read = jupytext.read
+    reads = []
+
+    def read_and_record(fp, *args, **kwargs):
+        reads.append(fp)
+        return read(fp, *args, **kwargs)
+
+    monkeypatch.setattr("implectus.main.jupytext.read", read_and_record)
+    sync(config)
+    assert reads
+
+
+def test_sync_doesnt_rewrite_unchanged_manifest(config, monkeypatch):
+    config.source_path.mkdir()
+    Path("notebooks/main.py").write_text(source)
+    monkeypatch.setattr("implectus.util.TIMESTAMP_RESOLUTION_NS", 0)
+    sync(config)
+
+    def save_manifest(*args):
+        raise AssertionError("Manifest should not have been saved")
+
+    monkeypatch.setattr("implectus.main._save_manifest", save_manifest)
+    sync(config)
+
+
+@pytest.mark.parametrize("outputs", (None, [], "package/main.py"))
+def test_sync_reexports_invalid_manifest_entry(config, outputs):
+    config.source_path.mkdir()
+    Path("notebooks/main.py").write_text(source)
+    sync(config)
+    manifest = json.loads(Path(SYNC_MANIFEST_FILENAME).read_text())
+    (entry,) = manifest.values()
+    if outputs is None:
+        del entry["outputs"]
+    else:
+        entry["outputs"] = outputs
+    Path(SYNC_MANIFEST_FILENAME).write_text(json.dumps(manifest))
+
+    Path("package/main.py").unlink()
+    sync(config)
+    assert code_equal("package/main.py", code)
+
+
+def test_sync_without_manifest(config, monkeypatch):
+    config.source_path.mkdir()
+    Path("notebooks/main.py").write_text(source)
+    sync(config, use_manifest=False)
+    assert not Path(SYNC_MANIFEST_FILENAME).exists()
+
+    sync(config)
+    _forbid_reading(monkeypatch)
+    with pytest.raises(AssertionError):
+        sync(config, use_manifest=False)
+
+
 # TODO: try everything by changing root dir and by changing working dir
@@ -1,11 +1,14 @@
+import os
 import textwrap
+import time
+import unittest.mock as mock
 from pathlib import Path
 
 import jupytext
 import pytest
 from tornado.web import HTTPError
 
-from implectus import ImplectusContentsManager
+from implectus import ImplectusContentsManager, load_jupyter_server_extension
 from implectus.server_extension import build_implectus_contents_manager_class
 from implectus.util import nb_cell
 
@@ -18,15 +21,17 @@ from .util import (
     write_config,
 )
 
+BuiltContentsManager = build_implectus_contents_manager_class(
+    jupytext.TextFileContentsManager
+)
+
 
 @pytest.fixture(params=[True, False])
 def cm(tmpdir_cd, request):
     """Create a temporary directory, change to it, and return a contents manager."""
     should_build = request.param
     if should_build:
-        class_ = build_implectus_contents_manager_class(
-            jupytext.TextFileContentsManager
-        )
+        class_ = BuiltContentsManager
     else:
         class_ = ImplectusContentsManager
     cm = class_(
@@ -34,6 +39,8 @@ def cm(tmpdir_cd, request):
         code_dir="package",
         doc_dir="doc",
         export_code_as_package=True,
+        # Tests wait for exports explicitly, so don't wait for more saves first
+        export_delay=0,
     )
     return cm
 
@@ -99,6 +106,7 @@ def test_does_nothing_by_default(tmpdir_cd, path):
 
     nb = cm.get("/" + path)
     cm.save(nb, "/" + path)
+    cm.wait_for_exports()
 
     assert no_extra_files(expected=[path])
 
@@ -111,6 +119,7 @@ def test_only_code_output(tmpdir_cd):
 
     nb = cm.get("/main.py")
     cm.save(nb, "/main.py")
+    cm.wait_for_exports()
 
     assert code_equal("package/main.py", code)
     assert no_extra_files(expected=["main.py", "package/main.py"])
@@ -124,11 +133,28 @@ def test_only_doc_output(tmpdir_cd):
 
     nb = cm.get("/main.py")
     cm.save(nb, "/main.py")
+    cm.wait_for_exports()
 
     assert doc_equal("docs/main.ipynb", doc.replace("package.", ""))
     assert no_extra_files(expected=["main.py", "docs/main.ipynb"])
 
 
+@pytest.mark.parametrize("output", ("code_dir", "doc_dir"))
+def test_save_twice_with_one_output(tmpdir_cd, output):
+    cm = ImplectusContentsManager(source_dir=".", export_delay=0)
+    setattr(cm, output, "out")
+    Path("main.py").write_text(source)
+
+    nb = cm.get("/main.py")
+    cm.save(nb, "/main.py")
+    cm.wait_for_exports()
+    cm.save(nb, "/main.py")
+    cm.wait_for_exports()
+
+    expected = "out/main.py" if output == "code_dir" else "out/main.ipynb"
+    assert no_extra_files(expected=["main.py", expected])
+
+
 @pytest.mark.parametrize("path", ("notebooks/main.py", "notebooks/main.ipynb"))
 def test_load_save(cm, path):
     cm.source_path.mkdir()
@@ -136,6 +162,7 @@ def test_load_save(cm, path):
 
     nb = cm.get("/" + path)
     cm.save(nb, "/" + path)
+    cm.wait_for_exports()
 
     assert nb_to_py(path) == source
     assert code_equal("package/main.py", code.replace("main.py", path))
@@ -157,6 +184,7 @@ def test_jupytext_still_works(cm, path):
     model = dict(type="notebook", content=nb, format="json")
 
     cm.save(model, "/" + path)
+    cm.wait_for_exports()
 
     assert Path(path).read_text() == source
     assert nb_to_py(Path(path).with_suffix(".ipynb")) == source
@@ -181,6 +209,7 @@ def test_load_save_with_config_file(tmpdir_cd):
     cm = ImplectusContentsManager()
     nb = cm.get("/src/main.py")
     cm.save(nb, "/src/main.py")
+    cm.wait_for_exports()
 
     assert Path("src/main.py").read_text() == source
     expected_code = code.replace("main.py", "src/main.py")
@@ -209,6 +238,7 @@ def test_load_save_outside_source_dir_with_config_file(tmpdir_cd):
     cm = ImplectusContentsManager()
     nb = cm.get("/src/main.py")
     cm.save(nb, "/src/main.py")
+    cm.wait_for_exports()
 
     assert Path("src/main.py").read_text() == source
     assert no_extra_files(expected=["src/main.py"])
@@ -230,6 +260,38 @@ def test_get_config_in_subdir(tmpdir_cd):
     assert config.source_path == Path("src/notebooks")
 
 
+def test_get_config_cached(tmpdir_cd, monkeypatch):
+    # Cache config files even if they were just modified
+    monkeypatch.setattr("implectus.util.TIMESTAMP_RESOLUTION_NS", 0)
+    write_config("implectus.yaml", dict(source_dir="notebooks"))
+    os.utime("implectus.yaml", ns=(0, 0))
+    cm = ImplectusContentsManager()
+    config = cm.get_config("notebooks/main.py")
+    assert config.source_dir == "notebooks"
+    assert cm.get_config("notebooks/other.py") is config
+
+    # Same size and modification time, as after a quick edit on a coarse filesystem
+    write_config("implectus.yaml", dict(source_dir="notebookz"))
+    os.utime("implectus.yaml", ns=(0, 0))
+    assert cm.get_config("notebooks/main.py").source_dir == "notebookz"
+
+
+def test_get_config_rereads_recent_config_file(tmpdir_cd):
+    write_config("implectus.yaml", dict(source_dir="notebooks"))
+    cm = ImplectusContentsManager()
+    config = cm.get_config("notebooks/main.py")
+    assert config.source_dir == "notebooks"
+    assert cm.get_config("notebooks/other.py") is not config
+
+
+def test_get_config_finds_new_config_file(tmpdir_cd):
+    cm = ImplectusContentsManager()
+    assert cm.get_config("notebooks/main.py") is cm
+
+    write_config("implectus.yaml", dict(source_dir="notebooks"))
+    assert cm.get_config("notebooks/main.py").source_dir == "notebooks"
+
+
 def test_load_save_with_config_in_subdir(tmpdir_cd):
     Path("src").mkdir()
     write_config(
@@ -247,6 +309,7 @@ def test_load_save_with_config_in_subdir(tmpdir_cd):
     cm = ImplectusContentsManager()
     nb = cm.get("/src/notebooks/main.py")
     cm.save(nb, "/src/notebooks/main.py")
+    cm.wait_for_exports()
 
     assert Path("src/notebooks/main.py").read_text() == source
 
@@ -269,6 +332,7 @@ def test_dont_overwrite_existing_code(cm):
     nb = cm.get("/notebooks/main.py")
     with pytest.raises(HTTPError):
         cm.save(nb, "/notebooks/main.py")
+    cm.wait_for_exports()
 
     assert nb_to_py("notebooks/main.py") == source
     assert Path("package/main.py").read_text() == "Handwritten file"
@@ -286,7 +350,146 @@ def test_dont_overwrite_existing_doc(cm):
     nb = cm.get("/notebooks/main.py")
     with pytest.raises(HTTPError):
         cm.save(nb, "/notebooks/main.py")
+    cm.wait_for_exports()
 
     assert nb_to_py("notebooks/main.py") == source
     assert nb_to_py("doc/main.ipynb").strip() == "# Handwritten notebook"
     # Don't care whether or not code is exported
+
+
+def test_log_background_export_error(cm):
+    cm.source_path.mkdir()
+    jupytext.write(jupytext.reads(source, fmt="py:light"), "notebooks/main.py")
+    nb = cm.get("/notebooks/main.py")
+
+    error = OSError("Disk full")
+    with mock.patch("implectus.main.write_files", side_effect=error):
+        with mock.patch.object(cm.log, "error") as log_error:
+            cm.save(nb, "/notebooks/main.py")
+            cm.wait_for_exports()
+    assert error in log_error.call_args[0]
+
+    # The next save isn't affected, and exports everything again
+    cm.save(nb, "/notebooks/main.py")
+    cm.wait_for_exports()
+    assert code_equal("package/main.py", code.replace("main.py", "notebooks/main.py"))
+    assert doc_equal("doc/main.ipynb", doc.replace("main.py", "notebooks/main.py"))
+
+
+def test_superseded_running_export_doesnt_write(cm):
+    cm.source_path.mkdir()
+    jupytext.write(jupytext.reads(source, fmt="py:light"), "notebooks/main.py")
+    nb = cm.get("/notebooks/main.py")
+
+    with mock.patch("implectus.main.write_files") as write_files:
+        # Hold up the first export after it's started
+        with cm._export_lock:
+            cm.save(nb, "/notebooks/main.py")
+            (future,) = cm._pending_exports["notebooks/main.py"]
+            deadline = time.monotonic() + 5
+            while not future.running():
+                assert time.monotonic() < deadline, "Export didn't start"
+                time.sleep(0.01)
+            nb["content"].cells[-1].source = "hello()\nhello()"
+            cm.save(nb, "/notebooks/main.py")
+        cm.wait_for_exports()
+        future.result()
+
+    # Only the second save was written
+    write_files.assert_called_once()
+    files = dict(write_files.call_args[0][0])
+    doc_nb = jupytext.reads(files[Path("doc/main.ipynb")], fmt="ipynb")
+    assert doc_nb.cells[-1].source == "hello()\nhello()"
+
+
+def test_debounce_exports(cm):
+    cm.export_delay = 10
+    cm.source_path.mkdir()
+    jupytext.write(jupytext.reads(source, fmt="py:light"), "notebooks/main.py")
+    nb = cm.get("/notebooks/main.py")
+
+    with mock.patch("implectus.main.write_files") as write_files:
+        cm.save(nb, "/notebooks/main.py")
+        nb["content"].cells[-1].source = "hello()\nhello()"
+        cm.export_delay = 0
+        cm.save(nb, "/notebooks/main.py")
+        cm.wait_for_exports()
+
+    # Only the second save was exported
+    write_files.assert_called_once()
+    files = dict(write_files.call_args[0][0])
+    doc_nb = jupytext.reads(files[Path("doc/main.ipynb")], fmt="ipynb")
+    assert doc_nb.cells[-1].source == "hello()\nhello()"
+
+
+def test_export_in_foreground(cm):
+    cm.export_in_background = False
+    cm.source_path.mkdir()
+    jupytext.write(jupytext.reads(source, fmt="py:light"), "notebooks/main.py")
+
+    nb = cm.get("/notebooks/main.py")
+    cm.save(nb, "/notebooks/main.py")
+
+    assert code_equal("package/main.py", code.replace("main.py", "notebooks/main.py"))
+    assert doc_equal("doc/main.ipynb", doc.replace("main.py", "notebooks/main.py"))
+
+
+def test_skip_unchanged_exports(cm):
+    cm.source_path.mkdir()
+    jupytext.write(jupytext.reads(source, fmt="py:light"), "notebooks/main.py")
+    nb = cm.get("/notebooks/main.py")
+    cm.save(nb, "/notebooks/main.py")
+    cm.wait_for_exports()
+
+    patch = mock.patch("implectus.server_extension.write_exports", return_value=None)
+    with patch as write_exports:
+        cm.save(nb, "/notebooks/main.py")
+        assert write_exports.call_args[1]["export_code"] is False
+        assert write_exports.call_args[1]["export_doc"] is False
+
+        # Changing a cell which isn't exported only affects the docs
+        nb["content"].cells[-1].source = "hello()\nhello()"
+        cm.save(nb, "/notebooks/main.py")
+        assert write_exports.call_args[1]["export_code"] is False
+        assert write_exports.call_args[1]["export_doc"] is True
+
+        # Changing the notebook metadata affects both
+        nb["content"].metadata["kernelspec"] = dict(name="other", display_name="Other")
+        cm.save(nb, "/notebooks/main.py")
+        assert write_exports.call_args[1]["export_code"] is True
+        assert write_exports.call_args[1]["export_doc"] is True
+
+    # Deleted exports are written again
+    Path("package/main.py").unlink()
+    cm.save(nb, "/notebooks/main.py")
+    cm.wait_for_exports()
+    assert code_equal("package/main.py", code.replace("main.py", "notebooks/main.py"))
+
+
+def test_subclass(tmpdir_cd):
+    class SubclassContentsManager(ImplectusContentsManager):
+        pass
+
+    cm = SubclassContentsManager(source_dir=".", code_dir="package")
+    Path("main.py").write_text(source)
+    nb = cm.get("/main.py")
+    cm.save(nb, "/main.py")
+    cm.wait_for_exports()
+
+    assert Path("main.py").read_text() == source
+    assert code_equal("package/main.py", code)
+
+
+def test_load_server_extension_once():
+    app = mock.Mock(contents_manager_class=jupytext.TextFileContentsManager)
+    with mock.patch("implectus.server_extension.replace_contents_manager") as replace:
+        load_jupyter_server_extension(app)
+        load_jupyter_server_extension(app)
+    replace.assert_called_once_with(app)
+
+
+def test_load_server_extension_already_configured():
+    app = mock.Mock(contents_manager_class=ImplectusContentsManager)
+    with mock.patch("implectus.server_extension.replace_contents_manager") as replace:
+        load_jupyter_server_extension(app)
+    replace.assert_not_called()
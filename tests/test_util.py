@@ -1,12 +1,24 @@
+import json
+import os
+import unittest.mock as mock
 from pathlib import Path
 
 import jupytext
+import nbformat
 import pytest
 
+from implectus.config import ImplectusConfiguration
+from implectus.export_code import writes_code
+from implectus.export_doc import writes_doc
 from implectus.util import (
+    cell_tags,
     implectus_header_cell,
     is_autogenerated,
     is_implectus_header_cell,
+    nb_cell,
+    shallow_nb_from_dict,
+    write_file,
+    write_files,
 )
 
 from .util import create_nb
@@ -30,5 +42,91 @@ def test_is_autogenerated_false(tmpdir_cd, filename):
     assert not is_autogenerated(filename)
 
 
+@pytest.mark.parametrize("filename", ("file.py", "file.ipynb", "file.md"))
+def test_is_autogenerated_header_not_first(tmpdir_cd, filename):
+    nb = create_nb(cells=[nb_cell("markdown", "Intro"), implectus_header_cell("a.py")])
+    jupytext.write(nb, filename)
+    assert not is_autogenerated(filename)
+
+
 def test_is_autogenerated_missing():
     assert not is_autogenerated("file_that_doesn't_exist")
+
+
+def test_cell_tags():
+    assert cell_tags(nb_cell("code")) == frozenset()
+    assert cell_tags(nb_cell("code", tags=[])) == frozenset()
+    assert cell_tags(nb_cell("code", tags=["export", "hide"])) == {"export", "hide"}
+
+
+def test_shallow_nb_from_dict():
+    source = '# + tags=["export"]\ndef hello():\n    print("Hello world")\n'
+    full_nb = jupytext.reads(source, fmt="py:light")
+    full_nb.cells[0].outputs = [
+        nbformat.v4.new_output("stream", name="stdout", text="Hello world\n")
+    ]
+
+    # Plain dicts, as in the model passed to the contents manager
+    nb = shallow_nb_from_dict(json.loads(json.dumps(full_nb)))
+    assert nb.cells[0].metadata.tags == ["export"]
+    # Outputs aren't converted
+    assert type(nb.cells[0].outputs[0]) is dict
+
+    # Can still be exported
+    cfg = ImplectusConfiguration(source_dir=".", code_dir="package", doc_dir="doc")
+    assert writes_code(nb, "main.py", cfg) == writes_code(full_nb, "main.py", cfg)
+    doc = json.loads(writes_doc(nb, "main.py", cfg))
+    expected_doc = json.loads(writes_doc(full_nb, "main.py", cfg))
+    for cell in doc["cells"] + expected_doc["cells"]:
+        # Cells created by Implectus get random IDs
+        cell.pop("id", None)
+    assert doc == expected_doc
+    assert doc["cells"][-1]["outputs"][0]["text"] == ["Hello world\n"]
+
+    # Already converted
+    assert shallow_nb_from_dict(full_nb) is full_nb
+
+
+def test_write_file_unchanged(tmpdir_cd):
+    write_file("dir/file.py", "content\n")
+    os.utime("dir/file.py", ns=(0, 0))
+    write_file("dir/file.py", "content\n")
+    assert os.stat("dir/file.py").st_mtime_ns == 0
+
+    write_file("dir/file.py", "content\nmore content\n")
+    assert Path("dir/file.py").read_text() == "content\nmore content\n"
+    write_file("dir/file.py", "content")
+    assert Path("dir/file.py").read_text() == "content"
+
+
+def test_write_files_rolls_back(tmpdir_cd):
+    write_files([("a.py", "a"), ("b/b.py", "b")])
+    assert Path("a.py").read_text() == "a"
+    assert Path("b/b.py").read_text() == "b"
+
+    replace = os.replace
+
+    def fail_on_c(src, dst):
+        if dst == "c.py":
+            raise OSError("Can't replace")
+        replace(src, dst)
+
+    with mock.patch("os.replace", side_effect=fail_on_c):
+        with pytest.raises(OSError):
+            write_files([("a.py", "new a"), ("b/b.py", "new b"), ("c.py", "c")])
+    assert Path("a.py").read_text() == "a"
+    assert Path("b/b.py").read_text() == "b"
+    assert sorted(os.listdir()) == ["a.py", "b"]
+    assert os.listdir("b") == ["b.py"]
+
+
+@pytest.mark.parametrize("filename", ("file.py", "file.ipynb", "file.md"))
+def test_is_autogenerated_large(tmpdir_cd, filename):
+    large_cell = nb_cell("markdown", "Large cell\n" * 1000)
+    nb = create_nb(cells=[implectus_header_cell("file.py"), large_cell])
+    jupytext.write(nb, filename)
+    assert is_autogenerated(filename)
+
+    nb = create_nb(cells=[large_cell, implectus_header_cell("file.py")])
+    jupytext.write(nb, filename)
+    assert not is_autogenerated(filename)
@@ -1,7 +1,8 @@
 import json
+import os
 import re
 from pathlib import Path
-from typing import Iterable, List
+from typing import AbstractSet, FrozenSet, Iterable, Iterator, Set, Tuple
 
 import jupytext
 import pytest
@@ -44,28 +45,24 @@ def nb_to_py(path, strip_metadata=True):
     return jupytext.writes(nb, fmt="py:light")
 
 
-def _strip_trailing_slash(pattern_or_patterns):
-    if pattern_or_patterns is None:
-        return []
-    elif type(pattern_or_patterns) in (list, tuple):
-        return [_strip_trailing_slash(pattern) for pattern in pattern_or_patterns]
-    else:
-        pattern = str(pattern_or_patterns)
-        if pattern.endswith("/"):
-            pattern = pattern[:-1]
-        return pattern
+def _expected_paths(expected) -> FrozenSet[str]:
+    """Normalize the `expected` argument of `no_extra_files` to a set of paths."""
+    if expected is None:
+        return frozenset()
+    if isinstance(expected, (str, os.PathLike)):
+        # A single path
+        expected = [expected]
+    return frozenset(str(path).rstrip("/") for path in expected)
 
 
 def _path_expected(path: Path, expected):
-    """Check if the given path or one of its parent dirs is in `expected`.
+    """Check if the given path is in `expected`.
 
-    Also ignore config files and .ipynb_checkpoints.
+    The parent dirs aren't checked, since `no_extra_files` doesn't look inside expected
+    dirs.  Also ignore config files and .ipynb_checkpoints.
     """
-    if _strip_trailing_slash(path) in expected:
+    if str(path) in expected:
         return True
-    for parent in path.parents:
-        if str(parent) in expected:
-            return True
 
     # Ignore these as well to save typing
     if path.name in IMPLECTUS_CONFIG_FILES or ".ipynb_checkpoints" in path.parts:
@@ -73,22 +70,46 @@ def _path_expected(path: Path, expected):
     return False
 
 
+def _walk(
+    path, skip_dirs: AbstractSet[str] = frozenset()
+) -> Iterator[Tuple[Path, bool]]:
+    """Yield (path, is_dir) for everything under `path`, parents before children.
+
+    Directories in `skip_dirs` are yielded but not descended into.
+    """
+    stack = [str(path)]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                is_dir = entry.is_dir()
+                entry_path = Path(entry.path)
+                yield entry_path, is_dir
+                if (
+                    is_dir
+                    and not entry.is_symlink()
+                    and str(entry_path) not in skip_dirs
+                ):
+                    stack.append(entry.path)
+
+
 def no_extra_files(path=".", expected: Iterable = None):
     """Check if the given path contains only files and dirs from `expected`.
 
     Also ignore config files and .ipynb_checkpoints.
     """
-    expected = _strip_trailing_slash(expected)
-    unexpected_dirs = []  # type: List[str]
-    for file in Path(path).glob("**/*"):
-        if _path_expected(file, expected):
-            # Drop parent dir from unexpected_dirs list
-            for parent in file.parents:
-                if str(parent) in unexpected_dirs:
-                    unexpected_dirs.remove(str(parent))
+    expected_paths = _expected_paths(expected)
+    root = Path(path)
+    if any(str(p) in expected_paths for p in (root, *root.parents)):
+        return True
+    unexpected_dirs = set()  # type: Set[str]
+    # Everything in an expected directory is expected, so don't bother looking in them
+    for file, is_dir in _walk(path, expected_paths):
+        if _path_expected(file, expected_paths):
+            # Drop parent dirs from unexpected_dirs
+            unexpected_dirs.difference_update(str(parent) for parent in file.parents)
             continue
-        if file.is_dir():
-            unexpected_dirs.append(str(file))
+        if is_dir:
+            unexpected_dirs.add(str(file))
             continue
         print("Unexpected file", file)
         return False
@@ -97,10 +118,12 @@ def no_extra_files(path=".", expected: Iterable = None):
 
 def _resolve_code(code_or_file, _load=lambda f: Path(f).read_text()):
     """If `code_or_file` is a filename then load it, otherwise return it as-is."""
-    if type(code_or_file) is str and ("\n" in code_or_file or len(code_or_file) > 256):
+    if isinstance(code_or_file, str) and (
+        "\n" in code_or_file or len(code_or_file) > 256
+    ):
         # Probably code
         return code_or_file
-    if type(code_or_file) is str and code_or_file.endswith(".py"):
+    if isinstance(code_or_file, str) and code_or_file.endswith(".py"):
         # Probably filename
         assert Path(code_or_file).is_file()
         return _load(code_or_file)